@@ -1,72 +1,513 @@
-import errno
+import argparse
+import array
+import asyncio
+import collections
+import heapq
+import itertools
 import socket
+import struct
 import sys
-import json
+import threading
+import mmap
+import multiprocessing
+import os
+import selectors
+import shutil
+import signal
+import tempfile
+import time
+import zlib
 
-def listen(rr_table, connection):
+from dnswire import (
+    DNSTypes, DropReport, FLAG_RESPONSE, MALFORMED_DATAGRAM_ERRORS, MAX_DATAGRAM, NO_TTL, RFC1035_NOERROR,
+    RFC1035_NOTIMP, build_batch_response, build_response, deserialize
+)
+
+# Zone files are parsed in chunks of about this many bytes, so memory stays bounded
+ZONE_CHUNK_SIZE = 16 * 1024 * 1024
+# Zone files this large are parsed by a process per CPU unless --load-workers says otherwise
+PARALLEL_ZONE_SIZE = 64 * 1024 * 1024
+# Largest ttl a zone file may give, as in RFC 2181
+MAX_ZONE_TTL = 2 ** 31 - 1
+
+# Compiled zone database, all integers in network byte order:
+#   header: magic:4s version:u8 pad:3 slot_count:u32 record_count:u32
+#   slots:  slot_count x (key_hash:u32 record_offset:u64), an open-addressing hash table;
+#           offsets count from the start of the record area, plus one, and 0 marks an empty slot
+#   records: key_length:u16 key (name NUL type) ttl:u32 static:u8 result_length:u16 result
+ZONE_DB_MAGIC = b"AZDB"
+ZONE_DB_VERSION = 1
+ZONE_DB_HEADER = struct.Struct("!4sBxxxII")
+ZONE_DB_SLOT = struct.Struct("!IQ")
+ZONE_DB_KEY = struct.Struct("!H")
+ZONE_DB_RECORD = struct.Struct("!IBH")
+
+
+def handle_query(rr_table, data, rfc1035=False, address=None, drops=None):
+    """
+    Looks up one query and returns the response to send back, in the query's wire format.
+
+    Returns None for a malformed datagram or one that is not a query, which gets no
+    answer; it is counted in `drops`, a DropReport, when one is given.
+    """
+    # Queries forwarded by the local server carry a transaction id, which the response echoes
     try:
-        while True:
-            # Wait for query
-            request, connection_addr = connection.receive_message()
-            #print(f"Amazoneserver: Recieved Request for {request} from {connection_addr}")
-            # Check RR table for record
-            record = rr_table.get_record(request)
-            if record:
-                #print(f"AmazoneServer: Record found for {request}")
-                response = [record['name'], record['type'], record['result'], 60, 0]
-                responsepack = json.dumps(response)
-                connection.send_message(responsepack, connection_addr)
-            
-            # If not found, add "Record not found" in the DNS response
-            # Else, return record in DNS response
-            else:
-                #print(f"record not found")
-                response = "Record Not Found"
-                connection.send_message(response, connection_addr)
-            # The format of the DNS query and response is in the project description
+        query = deserialize(data, rfc1035)
+    except MALFORMED_DATAGRAM_ERRORS as e:
+        # One bad datagram must not take the server down; it is dropped
+        if drops is not None:
+            drops.drop(address, e)
+        return None
+    # Only queries are answered; a response or a nameless message has nothing to look up
+    if query["flags"] & FLAG_RESPONSE or "batch" not in query and not query["name"]:
+        if drops is not None:
+            drops.drop(address, "not a query")
+        return None
+    if "batch" in query:
+        return build_batch_response(query, [lookup(rr_table, question) for question in query["batch"]])
+    # Answering another type as "any type" would hand out an RR of the wrong type
+    if query.get("unsupported_type"):
+        return build_response(query, query["name"], rfc1035_rcode=RFC1035_NOTIMP)
+    name, record_type, result, ttl = lookup(rr_table, query)
+    rcode = None
+    if result is None and query["format"] == "rfc1035" and query["type"] is not None and rr_table.get_record(query["name"]):
+        # The name exists with other types: NODATA rather than NXDOMAIN
+        rcode = RFC1035_NOERROR
+    return build_response(query, name, record_type, result, ttl, rcode)
+
+
+def lookup(rr_table, query):
+    """Returns the (name, type, result, ttl) answer to one question; result is None if not found."""
+    #print(f"Amazoneserver: Recieved Request for {query['name']}")
+    # Check RR table for record
+    record = rr_table.get_record(query["name"], query["type"])
+    if record:
+        #print(f"AmazoneServer: Record found for {query['name']}")
+        # Records from a zone file carry their own ttl
+        return record['name'], record['type'], record['result'], 60 if record['ttl'] in (None, "None") else record['ttl']
+    
+    # If not found, add "Record not found" in the DNS response
+    # Else, return record in DNS response
+    #print(f"record not found")
+    # The format of the DNS query and response is in the project description
+    return query["name"], query["type"], None, None
+
+
+def listen(rr_table, connection, rfc1035=False, dump_interval=None, dump_file=None):
+    """Serves `connection` (non-blocking) from a ReadinessLoop. See schedule_table_dumps() for table dumps."""
+    loop = ReadinessLoop()
+    drops = DropReport()
+
+    def on_readable():
+        # Take every query that is ready and answer them together
+        replies = [(handle_query(rr_table, data, rfc1035, connection_addr, drops), connection_addr)
+                   for data, connection_addr in connection.receive_ready()]
+        connection.send_many([reply for reply in replies if reply[0] is not None])
 
-            # Display RR table
-            rr_table.display_table()
+    loop.add_reader(connection.socket, on_readable)
+    schedule_table_dumps(loop, rr_table, dump_interval, dump_file)
+    try:
+        loop.run()
     except KeyboardInterrupt:
         print("Keyboard interrupt received, exiting...")
     finally:
+        loop.close()
         connection.close()
         pass
 
-def main():
-    rr_table = RRTable()
-    connection = UDPConnection()
-    # Add initial records
-    # These can be found in the test cases diagram
-    rr_table.add_record("shop.amazone.com", "A", "3.33.147.88", "None", 1)
-    rr_table.add_record("cloud.amazone.com", "A", "15.197.140.28", "None", 1)
-    amazone_dns_address = ("127.0.0.1", 22000)
+
+class AmazoneDNSProtocol(asyncio.DatagramProtocol):
+    """asyncio counterpart of listen(): answers each datagram as it arrives, without polling."""
+
+    def __init__(self, rr_table, rfc1035=False):
+        self.rr_table = rr_table
+        self.rfc1035 = rfc1035
+        self.drops = DropReport()
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        response = handle_query(self.rr_table, data, self.rfc1035, addr, self.drops)
+        if response is not None:
+            self.transport.sendto(response, addr)
+
+
+async def listen_async(rr_table, address, reuse_port=False, rfc1035=False, dump_interval=None, dump_file=None):
+    """Serves queries on `address` with AmazoneDNSProtocol until cancelled."""
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: AmazoneDNSProtocol(rr_table, rfc1035), local_addr=address, reuse_port=reuse_port or None
+    )
+    schedule_table_dumps(loop, rr_table, dump_interval, dump_file)
+    try:
+        await loop.create_future()
+    finally:
+        transport.close()
+
+
+def serve(rr_table, address, use_async, reuse_port=False, rfc1035=False, dump_interval=None, dump_file=None):
+    """Binds `address` and serves rr_table with the chosen loop until interrupted."""
+    if use_async:
+        try:
+            asyncio.run(listen_async(rr_table, address, reuse_port, rfc1035, dump_interval, dump_file))
+        except KeyboardInterrupt:
+            print("Keyboard interrupt received, exiting...")
+        return
+
+    connection = UDPConnection(timeout=0, reuse_port=reuse_port)
     # Bind address to UDP socket
-    connection.bind(amazone_dns_address)
+    connection.bind(address)
     #print("amazone server ready to recieve")
-    listen(rr_table, connection)
+    listen(rr_table, connection, rfc1035, dump_interval, dump_file)
+
+
+def serve_workers(rr_table, address, use_async, workers, rfc1035=False, dump_interval=None, dump_file=None):
+    """
+    Forks `workers` processes that all bind `address` with SO_REUSEPORT.
+
+    The zone is loaded into rr_table before forking, so every worker serves the
+    same copy-on-write table and the kernel spreads queries across them.
+    """
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                serve(rr_table, address, use_async, True, rfc1035, dump_interval, dump_file)
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    # Treat SIGTERM like Ctrl+C so stopping the parent also stops the workers
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    # A table dump asked of the parent would otherwise kill it; every worker has the same table, so one dumps it
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: os.kill(children[0], signal.SIGUSR1))
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        # Workers share our terminal and get the interrupt too; make sure they go
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+
+
+def write_atomically(path, write, mode="w"):
+    """
+    Calls write(file) on a new temporary file next to `path`, then renames it over `path`.
+
+    Readers see the old file or the new one, never a partial one. Each call gets its
+    own temporary file, so writes that overlap cannot corrupt each other.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                     prefix=f"{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode) as temp_file:
+            write(temp_file)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def dump_table(rr_table, dump_file=None):
+    """Prints the RR table, or writes it to dump_file, replacing the previous snapshot atomically."""
+    if dump_file is None:
+        rr_table.display_table()
+        return
+    write_atomically(dump_file, rr_table.display_table)
+
+
+def schedule_table_dumps(loop, rr_table, dump_interval=None, dump_file=None):
+    """
+    Dumps the RR table on SIGUSR1 (where there is one) and, with dump_interval, every dump_interval seconds.
+
+    `loop` is a ReadinessLoop or an asyncio loop. The dump runs on a background
+    thread, so queries are not held up by the table size or terminal speed.
+    """
+    def dump():
+        threading.Thread(target=dump_table, args=(rr_table, dump_file), daemon=True).start()
+
+    def dump_periodically():
+        dump()
+        loop.call_later(dump_interval, dump_periodically)
+
+    # Windows has no SIGUSR1
+    if hasattr(signal, "SIGUSR1"):
+        loop.add_signal_handler(signal.SIGUSR1, dump)
+    if dump_interval:
+        loop.call_later(dump_interval, dump_periodically)
+
+
+def parse_zone_line(line):
+    """
+    Parses one zone file line, "name [ttl] [IN] type result", into an add_record() tuple.
+
+    The ttl and IN may come in either order. Names are fully qualified, with or without
+    the trailing dot. Comments start with ';'. Returns None for blank and comment-only
+    lines. Records without a ttl are served with the default one.
+
+    Raises:
+        ValueError: For lines that cannot be loaded: $ directives such as $ORIGIN,
+            relative names such as "www" or "@", lines that start with whitespace to
+            reuse the previous name, record types the tables do not store (SOA, MX,
+            TXT...), ttls above MAX_ZONE_TTL, A/AAAA results that are not addresses
+            and malformed lines.
+    """
+    fields = line.split(";", 1)[0].split()
+    if not fields:
+        return None
+    if fields[0].startswith("$"):
+        raise ValueError(f"Unsupported directive in zone file line: {line.strip()!r}")
+    if line[0].isspace():
+        raise ValueError(f"Zone file line without a name: {line.strip()!r}")
+    try:
+        name, *rest = fields
+        ttl = "None"
+        has_class = False
+        while len(rest) > 2:
+            if rest[0].isdigit() and ttl == "None":
+                ttl = int(rest.pop(0))
+            elif rest[0].upper() == "IN" and not has_class:
+                rest.pop(0)
+                has_class = True
+            else:
+                break
+        record_type, result = rest
+    except (IndexError, ValueError):
+        raise ValueError(f"Bad zone file line: {line.strip()!r}") from None
+    record_type = record_type.upper()
+    if DNSTypes.get_type_code(record_type) is None:
+        raise ValueError(f"Unsupported record type {record_type} in zone file line: {line.strip()!r}")
+    if ttl != "None" and ttl > MAX_ZONE_TTL:
+        raise ValueError(f"ttl {ttl} above {MAX_ZONE_TTL} in zone file line: {line.strip()!r}")
+    name = name.rstrip(".")
+    if record_type in ("A", "AAAA"):
+        try:
+            socket.inet_pton(socket.AF_INET if record_type == "A" else socket.AF_INET6, result)
+        except OSError:
+            raise ValueError(f"Bad {record_type} address in zone file line: {line.strip()!r}") from None
+    else:
+        result = result.rstrip(".")
+    # Without $ORIGIN support a single label can only be a relative name
+    if "." not in name or record_type in ("NS", "CNAME") and "." not in result:
+        raise ValueError(f"Relative name in zone file line: {line.strip()!r}")
+    return name, record_type, result, ttl, 1
+
+
+def parse_zone_lines(lines):
+    """
+    Parses zone file lines, skipping the ones parse_zone_line() cannot load.
+
+    Returns:
+        tuple (records, skipped): the add_record() tuples and the number of lines skipped.
+    """
+    records = []
+    skipped = 0
+    for line in lines:
+        try:
+            record = parse_zone_line(line)
+        except ValueError:
+            skipped += 1
+            continue
+        if record:
+            records.append(record)
+    return records, skipped
+
+
+def parse_zone_chunk(path, start, end):
+    """Parses the lines of a zone file that start within the byte range [start, end). Returns (records, skipped)."""
+    with open(path, "rb") as zone:
+        previous = b"\n"
+        if start:
+            zone.seek(start - 1)
+            previous = zone.read(1)
+        data = zone.read(end - start)
+        # Finish a line running past `end`; one starting exactly at `end` belongs to the next chunk
+        if data and not data.endswith(b"\n"):
+            data += zone.readline()
+    # A line straddling `start` belongs to the previous chunk
+    if previous != b"\n":
+        data = data.partition(b"\n")[2]
+    return parse_zone_lines(data.decode().splitlines())
+
+
+def read_zone(path, workers=1, skipped=None):
+    """
+    Yields the records of a zone file without reading it into memory at once.
+
+    With several workers, chunks of the file are parsed by a process pool. Only
+    a few chunks are in flight at a time, so memory stays bounded however large
+    the file is, and records come out in file order. Lines that cannot be loaded
+    (see parse_zone_line()) are skipped and, given a collections.Counter
+    `skipped`, counted under `path`.
+    """
+    skipped = collections.Counter() if skipped is None else skipped
+    if workers <= 1:
+        with open(path) as zone:
+            for line in zone:
+                try:
+                    record = parse_zone_line(line)
+                except ValueError:
+                    skipped[path] += 1
+                    continue
+                if record:
+                    yield record
+        return
+
+    def finish(chunk):
+        records, chunk_skipped = chunk.get()
+        skipped[path] += chunk_skipped
+        return records
+
+    size = os.path.getsize(path)
+    with multiprocessing.Pool(workers) as pool:
+        in_flight = collections.deque()
+        for start in range(0, size, ZONE_CHUNK_SIZE):
+            in_flight.append(pool.apply_async(parse_zone_chunk, (path, start, min(start + ZONE_CHUNK_SIZE, size))))
+            if len(in_flight) >= 2 * workers:
+                yield from finish(in_flight.popleft())
+        while in_flight:
+            yield from finish(in_flight.popleft())
+
+
+def load_zone(rr_table, path, workers=None):
+    """
+    Bulk-loads a zone file into rr_table and reports the load rate.
+
+    workers defaults to one per CPU for files of PARALLEL_ZONE_SIZE or more, else 1.
+    """
+    if workers is None:
+        workers = os.cpu_count() if os.path.getsize(path) >= PARALLEL_ZONE_SIZE else 1
+    started = time.perf_counter()
+    skipped = collections.Counter()
+    count = rr_table.add_records(read_zone(path, workers, skipped))
+    elapsed = time.perf_counter() - started
+    print(f"Loaded {count} records from {path} in {elapsed:.2f}s ({count / elapsed:.0f} records/s), "
+          f"skipped {skipped[path]} unsupported or malformed lines")
+    return count
 
 
-def serialize():
-    # Consider creating a serialize function
-    # This can help prepare data to send through the socket
-    pass
+def zone_db_key(hostname, record_type):
+    return f"{hostname}\0{record_type}".encode()
 
 
-def deserialize():
-    # Consider creating a deserialize function
-    # This can help prepare data that is received from the socket
-    pass
+def compile_zone(records, path):
+    """
+    Compiles (hostname, record_type, result, ttl, static) tuples into a zone database at `path`.
+
+    Records are streamed to a temporary file and only their hashes and offsets are
+    kept in memory. Later records for the same name and type shadow earlier ones.
+    The file is replaced atomically. Returns the number of records written.
+    """
+    hashes = array.array("I")
+    offsets = array.array("Q")
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.TemporaryFile(dir=directory) as record_area:
+        offset = 0
+        for hostname, record_type, result, ttl, static in records:
+            key = zone_db_key(hostname, record_type)
+            result = result.encode()
+            entry = b"".join((
+                ZONE_DB_KEY.pack(len(key)), key,
+                ZONE_DB_RECORD.pack(NO_TTL if ttl in (None, "None") else ttl, static, len(result)), result
+            ))
+            record_area.write(entry)
+            hashes.append(zlib.crc32(key))
+            offsets.append(offset)
+            offset += len(entry)
+
+        # Power-of-two slot count at most half full, so probe sequences stay short
+        slot_count = 1
+        while slot_count < 2 * len(hashes):
+            slot_count *= 2
+        slots = bytearray(slot_count * ZONE_DB_SLOT.size)
+        # Newest first, so a lookup reaches the latest record for a key before older ones
+        for key_hash, record_offset in zip(reversed(hashes), reversed(offsets)):
+            slot = key_hash & (slot_count - 1)
+            while ZONE_DB_SLOT.unpack_from(slots, slot * ZONE_DB_SLOT.size)[1]:
+                slot = (slot + 1) & (slot_count - 1)
+            ZONE_DB_SLOT.pack_into(slots, slot * ZONE_DB_SLOT.size, key_hash, record_offset + 1)
+
+        def write(database):
+            database.write(ZONE_DB_HEADER.pack(ZONE_DB_MAGIC, ZONE_DB_VERSION, slot_count, len(hashes)))
+            database.write(slots)
+            record_area.seek(0)
+            shutil.copyfileobj(record_area, database)
+
+        write_atomically(path, write, "wb")
+    return len(hashes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Amazone authoritative DNS server")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="serve with asyncio instead of the blocking receive loop")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of SO_REUSEPORT worker processes to fork (default 1, no fork)")
+    parser.add_argument("--rfc1035", action="store_true",
+                        help="speak standard RFC 1035 DNS packets instead of the project formats")
+    parser.add_argument("--zone", action="append", default=[],
+                        help="load records from this zone file ('name [ttl] [IN] type result' per line, fully qualified "
+                             "names); may be repeated")
+    parser.add_argument("--load-workers", type=int,
+                        help="processes parsing each zone file (default: one per CPU for large files, else 1)")
+    parser.add_argument("--compile-zone", metavar="OUTPUT",
+                        help="compile the --zone files into a zone database at OUTPUT and exit")
+    parser.add_argument("--zone-db",
+                        help="also answer from this compiled zone database, mapped into memory instead of loaded")
+    parser.add_argument("--dump-interval", type=float,
+                        help="dump the RR table every this many seconds (it is always dumped on SIGUSR1)")
+    parser.add_argument("--dump-file",
+                        help="write RR table dumps to this file instead of stdout")
+    args = parser.parse_args()
+
+    if args.compile_zone:
+        started = time.perf_counter()
+        skipped = collections.Counter()
+        records = (record for zone_file in args.zone for record in read_zone(zone_file, args.load_workers or 1, skipped))
+        count = compile_zone(records, args.compile_zone)
+        print(f"Compiled {count} records into {args.compile_zone} in {time.perf_counter() - started:.2f}s, "
+              f"skipped {sum(skipped.values())} unsupported or malformed lines")
+        return
+
+    rr_table = RRTable(ZoneDatabase(args.zone_db) if args.zone_db else None)
+    # Add initial records
+    # These can be found in the test cases diagram
+    rr_table.add_record("shop.amazone.com", "A", "3.33.147.88", "None", 1)
+    rr_table.add_record("cloud.amazone.com", "A", "15.197.140.28", "None", 1)
+    for zone_file in args.zone:
+        load_zone(rr_table, zone_file, args.load_workers)
+    amazone_dns_address = ("127.0.0.1", 22000)
+    if args.workers > 1:
+        serve_workers(rr_table, amazone_dns_address, args.use_async, args.workers, args.rfc1035,
+                      args.dump_interval, args.dump_file)
+    else:
+        serve(rr_table, amazone_dns_address, args.use_async, False, args.rfc1035, args.dump_interval, args.dump_file)
 
 
 class RRTable:
-    def __init__(self):
+    def __init__(self, zone_db=None):
+        """Records not in the table are looked up in `zone_db`, a ZoneDatabase, if given."""
+        self.zone_db = zone_db
         self.records = {
             
         }
         self.record_number = 0
+        # Secondary index: (name, type) -> record number
+        self.index = {}
 
     def add_record(self, hostname, record_type, result, ttl, static):
+        # A new record replaces the old entry for the same name and type
+        old_id = self.index.get((hostname, record_type))
+        if old_id is not None:
+            del self.records[old_id]
         self.records[self.record_number] = {
                 "name": hostname,
                 "type": record_type,
@@ -74,95 +515,264 @@ class RRTable:
                 "ttl": ttl,
                 "static" : static
             }
+        self.index[(hostname, record_type)] = self.record_number
         self.record_number += 1
 
-    def get_record(self, hostname):
-        for record_id, record in self.records.items():
-            if(record["name"] == hostname):
-                return record
+    def add_records(self, records):
+        """
+        Bulk-inserts (hostname, record_type, result, ttl, static) tuples, e.g. from a zone file.
+
+        Same as calling add_record() for each, without the per-call overhead.
+        `records` may be any iterable and is consumed as it goes. Returns how many were added.
+        """
+        table = self.records
+        index = self.index
+        record_number = self.record_number
+        for hostname, record_type, result, ttl, static in records:
+            old_id = index.get((hostname, record_type))
+            if old_id is not None:
+                del table[old_id]
+            table[record_number] = {"name": hostname, "type": record_type, "result": result, "ttl": ttl, "static": static}
+            index[(hostname, record_type)] = record_number
+            record_number += 1
+        added = record_number - self.record_number
+        self.record_number = record_number
+        return added
+
+    def get_record(self, hostname, record_type=None):
+        if record_type is not None:
+            record_id = self.index.get((hostname, record_type))
+            if record_id is not None:
+                return self.records[record_id]
+            return self.zone_db.get_record(hostname, record_type) if self.zone_db is not None else None
+        # No type given: try each known type, still constant-time
+        for type_name in DNSTypes.name_to_code:
+            record_id = self.index.get((hostname, type_name))
+            if record_id is not None:
+                return self.records[record_id]
+        if self.zone_db is not None:
+            return self.zone_db.get_record(hostname, record_type)
         return None
 
-    def display_table(self):
+    def remove_record(self, hostname, record_type):
+        record_id = self.index.pop((hostname, record_type), None)
+        if record_id is not None:
+            del self.records[record_id]
+
+    def display_table(self, out=None):
+        """Writes the table to `out` (stdout by default)."""
+        records = list(self.records.values())
         # Display the table in the following format (include the column names):
-            # record_number,name,type,result,ttl,static
-            #print(f"{'record_number':<15}{'name':<20}{'type':<10}{'result':<30}{'ttl':<6}{'static':<6}")
-            #print('-' * 90)
-            print("record_no,name,type,result,ttl,static")
-            for record_id, record in self.records.items():
-                 #print(f"{record_id:<15}{record['name']:<20}{record['type']:<10}{record['result']:<30}{record['ttl']:<6}{record['static']:<6}")
-                 thing = str(record_id) + "," + str(record['name']) + "," + str(record['type']) + "," + str(record['result']) + "," + str(record['ttl']) + "," + str(record['static'])
-                 print(thing)
+        # record_number,name,type,result,ttl,static
+        lines = ["record_no,name,type,result,ttl,static"]
+        for record_no, record in enumerate(records):
+            lines.append(f"{record_no},{record['name']},{record['type']},{record['result']},{record['ttl']},{record['static']}")
+        out = out or sys.stdout
+        out.write("\n".join(lines) + "\n")
+        if self.zone_db is None:
+            return
+        # The zone database can be huge, so its rows are written a batch at a time
+        lines = []
+        for record_no, record in enumerate(self.zone_db.iter_records(), len(records)):
+            lines.append(f"{record_no},{record['name']},{record['type']},{record['result']},{record['ttl']},{record['static']}")
+            if len(lines) == 10000:
+                out.write("\n".join(lines) + "\n")
+                lines = []
+        if lines:
+            out.write("\n".join(lines) + "\n")
 
 
-class DNSTypes:
+class ZoneDatabase:
     """
-    A class to manage DNS query types and their corresponding codes.
+    Read-only lookups in a zone database built by compile_zone().
 
-    Examples:
-    >>> DNSTypes.get_type_code('A')
-    8
-    >>> DNSTypes.get_type_name(0b0100)
-    'AAAA'
+    The file is mapped into memory rather than loaded, so opening it is instant
+    and every worker process shares the same page-cache copy.
     """
 
-    name_to_code = {
-        "A": 0b1000,
-        "AAAA": 0b0100,
-        "CNAME": 0b0010,
-        "NS": 0b0001,
-    }
+    def __init__(self, path):
+        with open(path, "rb") as database:
+            self.map = mmap.mmap(database.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.slot_count, self.record_count = ZONE_DB_HEADER.unpack_from(self.map)
+        if magic != ZONE_DB_MAGIC or version != ZONE_DB_VERSION:
+            raise ValueError(f"{path} is not a version {ZONE_DB_VERSION} zone database")
+        self.records_start = ZONE_DB_HEADER.size + self.slot_count * ZONE_DB_SLOT.size
+
+    def get_record(self, hostname, record_type=None):
+        """Looks up a record like RRTable.get_record(). Returns a new dict, or None"""
+        if record_type is not None:
+            return self.__find(hostname, record_type)
+        for type_name in DNSTypes.name_to_code:
+            record = self.__find(hostname, type_name)
+            if record:
+                return record
+        return None
+
+    def iter_records(self):
+        """Yields every record in file order, including ones shadowed by a later duplicate."""
+        offset = self.records_start
+        while offset < len(self.map):
+            record, offset = self.__read_record(offset)
+            yield record
 
-    code_to_name = {code: name for name, code in name_to_code.items()}
+    def __find(self, hostname, record_type):
+        key = zone_db_key(hostname, record_type)
+        key_hash = zlib.crc32(key)
+        slot = key_hash & (self.slot_count - 1)
+        while True:
+            slot_hash, record_offset = ZONE_DB_SLOT.unpack_from(self.map, ZONE_DB_HEADER.size + slot * ZONE_DB_SLOT.size)
+            if not record_offset:
+                return None
+            if slot_hash == key_hash:
+                offset = self.records_start + record_offset - 1
+                (key_length,) = ZONE_DB_KEY.unpack_from(self.map, offset)
+                key_start = offset + ZONE_DB_KEY.size
+                if self.map[key_start:key_start + key_length] == key:
+                    return self.__read_record(offset)[0]
+            slot = (slot + 1) & (self.slot_count - 1)
 
-    @staticmethod
-    def get_type_code(type_name: str):
-        """Gets the code for the given DNS query type name, or None"""
-        return DNSTypes.name_to_code.get(type_name, None)
+    def __read_record(self, offset):
+        # Returns (record, offset of the next record)
+        (key_length,) = ZONE_DB_KEY.unpack_from(self.map, offset)
+        offset += ZONE_DB_KEY.size
+        hostname, _, record_type = str(self.map[offset:offset + key_length], "utf-8").partition("\0")
+        offset += key_length
+        ttl, static, result_length = ZONE_DB_RECORD.unpack_from(self.map, offset)
+        offset += ZONE_DB_RECORD.size
+        result = str(self.map[offset:offset + result_length], "utf-8")
+        return {
+            "name": hostname,
+            "type": record_type,
+            "result": result,
+            "ttl": "None" if ttl == NO_TTL else ttl,
+            "static": static
+        }, offset + result_length
 
-    @staticmethod
-    def get_type_name(type_code: int):
-        """Gets the DNS query type name for the given code, or None"""
-        return DNSTypes.code_to_name.get(type_code, None)
+
+class ReadinessLoop:
+    """
+    A single-threaded selectors (epoll/kqueue) loop.
+
+    It sleeps until a registered socket is readable or the next timer is due,
+    so an idle server does not wake up at all.
+    """
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        # Min-heap of (deadline, sequence, callback); the sequence breaks ties
+        self.timers = []
+        self.sequence = itertools.count()
+        # Signals are written to this socketpair by the interpreter, which wakes select() up
+        self.signal_handlers = {}
+        self.signal_reader = None
+        self.signal_writer = None
+
+    def add_reader(self, sock: socket.socket, callback):
+        """Calls callback() whenever `sock` has data to read."""
+        self.selector.register(sock, selectors.EVENT_READ, callback)
+
+    def call_at(self, deadline: float, callback):
+        """Calls callback() once time.monotonic() reaches `deadline`."""
+        heapq.heappush(self.timers, (deadline, next(self.sequence), callback))
+
+    def call_later(self, delay: float, callback):
+        """Calls callback() after `delay` seconds, like asyncio's loop.call_later."""
+        self.call_at(time.monotonic() + delay, callback)
+
+    def add_signal_handler(self, signum: int, callback):
+        """Calls callback() from the loop when `signum` arrives, like asyncio's loop.add_signal_handler."""
+        if self.signal_reader is None:
+            self.signal_reader, self.signal_writer = socket.socketpair()
+            self.signal_reader.setblocking(False)
+            self.signal_writer.setblocking(False)
+            signal.set_wakeup_fd(self.signal_writer.fileno())
+            self.add_reader(self.signal_reader, self.__dispatch_signals)
+        self.signal_handlers[signum] = callback
+        # The Python-level handler does nothing; the work happens in the loop, outside the handler
+        signal.signal(signum, lambda *_: None)
+
+    def __dispatch_signals(self):
+        try:
+            signums = self.signal_reader.recv(64)
+        except BlockingIOError:
+            return
+        for signum in signums:
+            if signum in self.signal_handlers:
+                self.signal_handlers[signum]()
+
+    def run(self):
+        """Dispatches readiness events and timers until interrupted."""
+        while True:
+            timeout = max(0, self.timers[0][0] - time.monotonic()) if self.timers else None
+            for key, _ in self.selector.select(timeout):
+                key.data()
+            now = time.monotonic()
+            while self.timers and self.timers[0][0] <= now:
+                _, _, callback = heapq.heappop(self.timers)
+                callback()
+
+    def close(self):
+        if self.signal_reader is not None:
+            signal.set_wakeup_fd(-1)
+            for signum in self.signal_handlers:
+                signal.signal(signum, signal.SIG_DFL)
+            self.signal_reader.close()
+            self.signal_writer.close()
+        self.selector.close()
 
 
 class UDPConnection:
     """A class to handle UDP socket communication, capable of acting as both a client and a server."""
 
-    def __init__(self, timeout: int = 1):
-        """Initializes the UDPConnection instance with a timeout. Defaults to 1."""
+    def __init__(self, timeout: int = 1, reuse_port: bool = False, batch_size: int = 64):
+        """
+        Initializes the UDPConnection instance with a timeout. Defaults to 1; 0 makes it non-blocking.
+
+        With reuse_port, several processes can bind the same address and the
+        kernel load-balances datagrams between them.
+        """
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.socket.settimeout(timeout)
         self.is_bound = False
+        # Receive buffers allocated once and reused for every datagram
+        self.buffers = [memoryview(bytearray(MAX_DATAGRAM)) for _ in range(batch_size)]
 
-    def send_message(self, message: str, address: tuple[str, int]):
-        """Sends a message to the specified address."""
-        self.socket.sendto(message.encode(), address)
+    def send_message(self, message: str | bytes, address: tuple[str, int]):
+        """Sends a message to the specified address. Strings are UTF-8 encoded first."""
+        if isinstance(message, str):
+            message = message.encode()
+        self.socket.sendto(message, address)
 
-    def receive_message(self):
+    def send_many(self, messages: list):
+        """Sends a list of (message, address) pairs, e.g. all replies from one receive_ready() call."""
+        sendto = self.socket.sendto
+        for message, address in messages:
+            if isinstance(message, str):
+                message = message.encode()
+            sendto(message, address)
+
+    def receive_ready(self):
         """
-        Receives a message from the socket.
+        Receives every datagram that is ready, without blocking.
 
-        Returns:
-            tuple (data, address): The received message and the address it came from.
+        Meant for a non-blocking connection (timeout=0) driven by a ReadinessLoop.
+        The returned memoryviews point into the reused buffers, so they are only
+        valid until the next call.
 
-        Raises:
-            KeyboardInterrupt: If the program is interrupted manually.
+        Returns:
+            list of (data, address) tuples, empty if nothing was ready.
         """
-        while True:
+        messages = []
+        for buffer in self.buffers:
             try:
-                data, address = self.socket.recvfrom(4096)
-                return data.decode(), address
-            except socket.timeout:
-                continue
-            except OSError as e:
-                if e.errno == errno.ECONNRESET:
-                    print("Error: Unable to reach the other socket. It might not be up and running.")
-                else:
-                    print(f"Socket error: {e}")
-                self.close()
-                sys.exit(1)
-            except KeyboardInterrupt:
-                raise
+                nbytes, address = self.socket.recvfrom_into(buffer)
+            except OSError:
+                # Nothing more ready, or e.g. ECONNREFUSED left by an earlier send; either way stop here
+                break
+            messages.append((buffer[:nbytes], address))
+        return messages
 
     def bind(self, address: tuple[str, int]):
         """Binds the socket to the given address. This means it will be a server."""
@@ -0,0 +1,274 @@
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+from client import LOCAL_DNS_ADDRESS
+from dnswire import FLAG_NOT_FOUND, deserialize, serialize
+from localserver import STATS_NAME
+
+# Names the servers start with; after the warm-up they are answered from the local cache
+EXISTING_NAMES = [
+    "www.csusm.edu",
+    "my.csusm.edu",
+    "amazone.com",
+    "dns.amazone.com",
+    "shop.amazone.com",
+    "cloud.amazone.com",
+]
+SERVER_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+class QueryMix:
+    """
+    Picks the name for each query.
+
+    A miss_ratio share of queries ask for a name never asked before, so each one goes
+    to the authoritative server. An nx_ratio share ask for one of nx_pool nonexistent
+    names, answered from the negative cache once seen. The rest ask for EXISTING_NAMES.
+    Both pools are drawn with Zipf popularity: the k-th name is picked with weight 1/k**s.
+    """
+
+    def __init__(self, miss_ratio=0.1, nx_ratio=0.0, nx_pool=1000, zipf_s=1.0, seed=None):
+        self.miss_ratio = miss_ratio
+        self.nx_ratio = nx_ratio
+        self.random = random.Random(seed)
+        self.unique = itertools.count()
+        # Unique names stay unique across runs against the same, still warm, local server
+        self.run_id = f"{os.getpid()}-{int(time.time())}"
+        self.existing = EXISTING_NAMES
+        self.existing_weights = self.zipf_weights(len(self.existing), zipf_s)
+        self.nonexistent = [f"nx{rank}.amazone.com" for rank in range(nx_pool)]
+        self.nonexistent_weights = self.zipf_weights(nx_pool, zipf_s)
+
+    @staticmethod
+    def zipf_weights(count, s):
+        """Cumulative Zipf weights for random.choices(cum_weights=...), which bisects them."""
+        return list(itertools.accumulate(1 / rank ** s for rank in range(1, count + 1)))
+
+    def next_name(self):
+        draw = self.random.random()
+        if draw < self.miss_ratio:
+            return f"miss{self.run_id}-{next(self.unique)}.amazone.com"
+        if draw < self.miss_ratio + self.nx_ratio:
+            return self.random.choices(self.nonexistent, cum_weights=self.nonexistent_weights)[0]
+        return self.random.choices(self.existing, cum_weights=self.existing_weights)[0]
+
+
+class QueryProtocol(asyncio.DatagramProtocol):
+    """One load-generating socket; answers are matched to their query by transaction id."""
+
+    def __init__(self):
+        self.waiting = {}
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        message = deserialize(data)
+        future = self.waiting.pop(message["transaction_id"], None)
+        # Answers that arrive after their query timed out are dropped
+        if future is not None and not future.done():
+            future.set_result(message)
+
+    def error_received(self, exc):
+        # e.g. ECONNREFUSED while the local server is down; the query times out
+        pass
+
+
+async def run_worker(address, mix, wire_format, measure_from, deadline, timeout, results):
+    """
+    Sends one query at a time and waits for its answer until `deadline`.
+
+    Latencies are only recorded after `measure_from`, so the warm-up fills the caches
+    without counting.
+    """
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(QueryProtocol, remote_addr=address)
+    try:
+        for transaction_id in itertools.cycle(range(1, 0x10000)):
+            started = time.monotonic()
+            if started >= deadline:
+                break
+            future = loop.create_future()
+            protocol.waiting[transaction_id] = future
+            transport.sendto(serialize({"transaction_id": transaction_id, "name": mix.next_name()}, wire_format))
+            try:
+                message = await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                protocol.waiting.pop(transaction_id, None)
+                if started >= measure_from:
+                    results["timeouts"] += 1
+                continue
+            if started >= measure_from:
+                results["latencies"].append(time.monotonic() - started)
+                results["not_found" if message["flags"] & FLAG_NOT_FOUND else "answered"] += 1
+    finally:
+        transport.close()
+
+
+async def run_load(address, mix, wire_format, concurrency, warmup, duration, timeout):
+    """Runs `concurrency` closed-loop workers for warmup + duration seconds and collects their results."""
+    results = {"latencies": [], "answered": 0, "not_found": 0, "timeouts": 0}
+    measure_from = time.monotonic() + warmup
+    deadline = measure_from + duration
+    await asyncio.gather(*(
+        run_worker(address, mix, wire_format, measure_from, deadline, timeout, results)
+        for _ in range(concurrency)
+    ))
+    return results
+
+
+def percentile(latencies, fraction):
+    """Returns the latency below which `fraction` of the sorted `latencies` fall, or None"""
+    if not latencies:
+        return None
+    return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+
+def summarize(results, duration):
+    """Turns raw worker results into the QPS and latency (in milliseconds) report."""
+    latencies = sorted(results["latencies"])
+    milliseconds = lambda seconds: None if seconds is None else round(seconds * 1000, 4)
+    return {
+        "queries": len(latencies) + results["timeouts"],
+        "answered": results["answered"],
+        "not_found": results["not_found"],
+        "timeouts": results["timeouts"],
+        "qps": round(len(latencies) / duration, 1),
+        "latency_ms": {
+            "mean": milliseconds(sum(latencies) / len(latencies) if latencies else None),
+            "p50": milliseconds(percentile(latencies, 0.5)),
+            "p99": milliseconds(percentile(latencies, 0.99)),
+            "p999": milliseconds(percentile(latencies, 0.999)),
+            "max": milliseconds(latencies[-1] if latencies else None),
+        },
+    }
+
+
+def query_stats(address, timeout=1):
+    """Asks the local server for its metrics snapshot. Returns the dict, or None if it does not answer."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(timeout)
+    try:
+        sock.sendto(serialize({"transaction_id": 0, "name": STATS_NAME}), address)
+        data, _ = sock.recvfrom(65535)
+        return json.loads(deserialize(data)["result"])
+    except (OSError, ValueError, TypeError):
+        return None
+    finally:
+        sock.close()
+
+
+def start_servers(local_args, amazone_args, address):
+    """Starts amazoneserver and localserver and waits until the local server answers."""
+    processes = [
+        subprocess.Popen([sys.executable, os.path.join(SERVER_DIRECTORY, script), *args],
+                         cwd=SERVER_DIRECTORY, stdout=subprocess.DEVNULL)
+        for script, args in (("amazoneserver.py", amazone_args), ("localserver.py", local_args))
+    ]
+    deadline = time.monotonic() + 5
+    while query_stats(address, timeout=0.2) is None:
+        if time.monotonic() > deadline or any(process.poll() is not None for process in processes):
+            stop_servers(processes)
+            raise RuntimeError("the servers did not start")
+    return processes
+
+
+def stop_servers(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.wait()
+
+
+def compare(report, baseline, tolerance):
+    """
+    Prints the change of each headline number against a previous report.
+
+    Returns:
+        list: the names of the numbers that got worse by more than `tolerance` (a fraction).
+    """
+    regressions = []
+    metrics = [("qps", report["qps"], baseline["qps"], True)] + [
+        (f"{label} latency", report["latency_ms"][label], baseline["latency_ms"][label], False)
+        for label in ("p50", "p99", "p999")
+    ]
+    for name, current, previous, higher_is_better in metrics:
+        if not current or not previous:
+            continue
+        change = (current - previous) / previous
+        print(f"{name}: {previous} -> {current} ({change:+.1%})")
+        if (-change if higher_is_better else change) > tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load-test the client -> localserver -> amazoneserver chain and report QPS and tail latency"
+    )
+    parser.add_argument("--duration", type=float, default=10, help="seconds to measure (default 10)")
+    parser.add_argument("--warmup", type=float, default=1, help="seconds of unmeasured load first (default 1)")
+    parser.add_argument("--concurrency", type=int, default=8, help="queries in flight at once (default 8)")
+    parser.add_argument("--timeout", type=float, default=1, help="seconds before a query counts as timed out")
+    parser.add_argument("--miss-ratio", type=float, default=0.1,
+                        help="share of queries for never-seen names, which go upstream (default 0.1)")
+    parser.add_argument("--nx-ratio", type=float, default=0.0,
+                        help="share of queries for a pool of nonexistent names (default 0)")
+    parser.add_argument("--nx-pool", type=int, default=1000, help="number of nonexistent names (default 1000)")
+    parser.add_argument("--zipf-s", type=float, default=1.0, help="Zipf exponent of name popularity (default 1.0)")
+    parser.add_argument("--seed", type=int, help="random seed for the query mix")
+    parser.add_argument("--json", dest="wire_format", action="store_const", const="json", default="binary",
+                        help="query in the older JSON format instead of binary")
+    parser.add_argument("--no-start", action="store_true",
+                        help="benchmark servers that are already running instead of starting them")
+    parser.add_argument("--local-args", default="", help="extra arguments for localserver.py, e.g. '--async'")
+    parser.add_argument("--amazone-args", default="", help="extra arguments for amazoneserver.py")
+    parser.add_argument("--output", help="save the report as JSON to this file")
+    parser.add_argument("--baseline", help="compare against a report saved by an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="with --baseline, exit 1 if any number is this much worse (default 0.1)")
+    args = parser.parse_args()
+    if args.miss_ratio + args.nx_ratio > 1:
+        parser.error("--miss-ratio and --nx-ratio add up to more than 1")
+
+    mix = QueryMix(args.miss_ratio, args.nx_ratio, args.nx_pool, args.zipf_s, args.seed)
+    processes = [] if args.no_start else start_servers(args.local_args.split(), args.amazone_args.split(),
+                                                       LOCAL_DNS_ADDRESS)
+    try:
+        results = asyncio.run(run_load(LOCAL_DNS_ADDRESS, mix, args.wire_format, args.concurrency,
+                                       args.warmup, args.duration, args.timeout))
+        server_stats = query_stats(LOCAL_DNS_ADDRESS)
+    finally:
+        stop_servers(processes)
+
+    report = {
+        "started": datetime.datetime.now().isoformat(timespec="seconds"),
+        "config": vars(args),
+        **summarize(results, args.duration),
+        "server_stats": server_stats,
+    }
+    print(json.dumps({key: report[key] for key in ("queries", "timeouts", "qps", "latency_ms")}, indent=2))
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump(report, out, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(report, json.load(baseline_file), args.tolerance)
+        if regressions:
+            print(f"Regressed beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+import argparse
+import json
+import os
+import random
+import threading
+import time
+import tracemalloc
+
+from localserver import RRTable
+
+# Lookups and lock samples per measurement, so large tables do not take forever
+OPERATIONS = 100_000
+LOCK_SAMPLES = 10_000
+
+
+class TimedLock:
+    """Wraps the RR table lock and records how long each holder kept it."""
+
+    def __init__(self, lock):
+        self.lock = lock
+        self.holds = []
+        self.acquired = 0
+
+    def __enter__(self):
+        self.lock.acquire()
+        self.acquired = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.holds.append(time.perf_counter() - self.acquired)
+        self.lock.release()
+
+
+def hostnames(count, prefix="host"):
+    return [f"{prefix}{number}.amazone.com" for number in range(count)]
+
+
+def build_table(names, ttl=3600):
+    rr_table = RRTable()
+    for number, name in enumerate(names):
+        rr_table.add_record(name, "A", f"10.{number >> 16 & 255}.{number >> 8 & 255}.{number & 255}", ttl, 0)
+    return rr_table
+
+
+def summarize_seconds(samples):
+    """p50/p99/max of a list of durations, in microseconds."""
+    if not samples:
+        return {"p50": None, "p99": None, "max": None}
+    samples = sorted(samples)
+    microseconds = lambda seconds: round(seconds * 1_000_000, 2)
+    return {
+        "p50": microseconds(samples[len(samples) // 2]),
+        "p99": microseconds(samples[min(len(samples) - 1, int(0.99 * len(samples)))]),
+        "max": microseconds(samples[-1]),
+    }
+
+
+def ops_per_second(operation, arguments):
+    started = time.perf_counter()
+    for argument in arguments:
+        operation(argument)
+    return round(len(arguments) / (time.perf_counter() - started))
+
+
+def lock_holds(rr_table, operation, arguments):
+    """Runs `operation` over `arguments` with a TimedLock in place and summarizes its hold times."""
+    timed_lock = TimedLock(rr_table.lock)
+    rr_table.lock = timed_lock
+    try:
+        for argument in arguments:
+            operation(argument)
+    finally:
+        rr_table.lock = timed_lock.lock
+    return summarize_seconds(timed_lock.holds)
+
+
+def bench_add_record(size):
+    names = hostnames(size)
+    started = time.perf_counter()
+    rr_table = build_table(names)
+    result = {"ops_per_second": round(size / (time.perf_counter() - started))}
+    extra = hostnames(min(size, LOCK_SAMPLES), "extra")
+    result["lock_hold_us"] = lock_holds(rr_table, lambda name: rr_table.add_record(name, "A", "10.0.0.1", 3600, 0), extra)
+    return rr_table, names, result
+
+
+def bench_get_record(rr_table, names):
+    """Typed and untyped hits, and misses, on random names."""
+    sample = random.choices(names, k=OPERATIONS)
+    misses = hostnames(OPERATIONS, "missing")
+    return {
+        "hit_ops_per_second": ops_per_second(lambda name: rr_table.get_record(name, "A"), sample),
+        "untyped_hit_ops_per_second": ops_per_second(rr_table.get_record, sample),
+        "miss_ops_per_second": ops_per_second(rr_table.get_record, misses),
+        "lock_hold_us": lock_holds(rr_table, lambda name: rr_table.get_record(name, "A"), sample[:LOCK_SAMPLES]),
+    }
+
+
+def bench_display_table(rr_table, size):
+    """Formats the whole table into /dev/null; the lock hold is the row copy."""
+    with open(os.devnull, "w") as devnull:
+        started = time.perf_counter()
+        rr_table.display_table(devnull)
+        elapsed = time.perf_counter() - started
+        return {
+            "rows_per_second": round(size / elapsed),
+            "seconds": round(elapsed, 4),
+            "lock_hold_us": lock_holds(rr_table, lambda _: rr_table.display_table(devnull), [None]),
+        }
+
+
+def bench_expiry(size):
+    """Reclaims `size` expired records in one sweep, as the TTL thread would after they all lapse."""
+    rr_table = build_table(hostnames(size), ttl=0)
+    with rr_table.lock:
+        started = time.perf_counter()
+        # A second ahead, since the sweep works on whole seconds
+        rr_table._RRTable__remove_expired_records(time.monotonic() + 1)
+        elapsed = time.perf_counter() - started
+    rr_table.close()
+    # The whole sweep runs under one lock hold
+    return {"records_per_second": round(size / elapsed), "records_left": len(rr_table), "lock_hold_us": summarize_seconds([elapsed])}
+
+
+def bench_racing_readers(size, readers, seconds):
+    """
+    Runs `readers` threads of get_record() while the TTL thread reclaims records.
+
+    Deadlines are spread over `seconds`, so each one-second sweep has about
+    size / seconds records to remove while the readers wait on the lock.
+    """
+    names = hostnames(size)
+    rr_table = RRTable()
+    for number, name in enumerate(names):
+        rr_table.add_record(name, "A", "10.0.0.1", seconds * number / size, 0)
+    timed_lock = TimedLock(rr_table.lock)
+    rr_table.lock = timed_lock
+    latencies = [[] for _ in range(readers)]
+    deadline = time.monotonic() + seconds
+
+    def read(samples):
+        local_random = random.Random()
+        while time.monotonic() < deadline:
+            name = local_random.choice(names)
+            started = time.perf_counter()
+            rr_table.get_record(name, "A")
+            samples.append(time.perf_counter() - started)
+
+    threads = [threading.Thread(target=read, args=(samples,)) for samples in latencies]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    rr_table.lock = timed_lock.lock
+    rr_table.close()
+    reads = [latency for samples in latencies for latency in samples]
+    return {
+        "readers": readers,
+        "reads_per_second": round(len(reads) / seconds),
+        "read_latency_us": summarize_seconds(reads),
+        "lock_hold_us": summarize_seconds(timed_lock.holds),
+        "records_left": len(rr_table),
+    }
+
+
+def bench_memory(size):
+    """Traced bytes per record for a table of `size` records, counting the name and result strings."""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        rr_table = build_table(hostnames(size))
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    rr_table.close()
+    return round((after - before) / size, 1)
+
+
+def run(size, readers, race_seconds, memory_max):
+    rr_table, names, add_result = bench_add_record(size)
+    result = {
+        "size": size,
+        "add_record": add_result,
+        "get_record": bench_get_record(rr_table, names),
+        "display_table": bench_display_table(rr_table, size),
+    }
+    # Frees the table before the next ones are built; its expiry thread would keep it alive
+    rr_table.close()
+    del rr_table, names
+    result["expiry"] = bench_expiry(size)
+    if readers:
+        result["racing_readers"] = bench_racing_readers(size, readers, race_seconds)
+    result["bytes_per_record"] = bench_memory(size) if size <= memory_max else None
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks for RRTable at increasing table sizes")
+    parser.add_argument("--sizes", default="1e3,1e4,1e5,1e6",
+                        help="comma-separated table sizes (default 1e3,1e4,1e5,1e6; 1e7 needs several GB)")
+    parser.add_argument("--readers", type=int, default=4,
+                        help="reader threads racing the TTL thread (default 4, 0 to skip)")
+    parser.add_argument("--race-seconds", type=float, default=3, help="length of the racing readers run (default 3)")
+    parser.add_argument("--memory-max", type=float, default=1e6,
+                        help="largest size to measure memory for, since tracing is slow (default 1e6)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the lookups (default 0)")
+    parser.add_argument("--output", help="save the results as JSON to this file")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    results = []
+    for size in (int(float(size)) for size in args.sizes.split(",")):
+        result = run(size, args.readers, args.race_seconds, args.memory_max)
+        print(json.dumps(result))
+        results.append(result)
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump(results, out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,39 +1,243 @@
+import argparse
+import collections
 import errno
+import heapq
+import itertools
+import math
 import socket
 import sys
 import threading
 import time
-import json
 
+from dnswire import (
+    DNSTypes, FLAG_NOT_FOUND, FLAG_TRUNCATED, MAX_DATAGRAM, NOT_FOUND, WIRE_BATCH_HEADER, WIRE_LENGTH, deserialize,
+    serialize, serialize_batch
+)
 
-def handle_request(hostname, rr_table, connection):
+# How long a "Record Not Found" answer is cached
+NEGATIVE_TTL = 30
+LOCAL_DNS_ADDRESS = ("127.0.0.1", 21000)
+# Source of transaction ids for queries to the local server
+transaction_ids = itertools.count()
+# What resolve_many() yields for a name that got no answer after all its retries
+TIMED_OUT = "Timed Out"
+
+
+def handle_request(hostname, rr_table, connection, wire_format="binary", timeout=1):
     # Check RR table for record
     record = rr_table.get_record(hostname)
         #print(f"Client: Record found for {hostname}:\n {record}")
     # If not found, ask the local DNS server, then save the record if valid
-    if not record:
+    # Names we were recently told do not exist are not asked for again
+    if not record and not rr_table.is_negative(hostname):
         #print(f"record not found for {hostname}. Asking local DNS server...")
-        local_dns_address = ("127.0.0.1", 21000)
-        connection.send_message(hostname, local_dns_address)
-        response, address = connection.receive_message()
-        responseunpack = json.loads(response)
-        if(response != "Record Not Found"):
-            rr_table.add_record(responseunpack[0], responseunpack[1], responseunpack[2], responseunpack[3], responseunpack[4])
-    rr_table.display_table()
+        # The older JSON format has no transaction id on client queries
+        transaction_id = next(transaction_ids) & 0xFFFF if wire_format == "binary" else None
+        query = {"transaction_id": transaction_id, "name": hostname}
+        connection.send_message(serialize(query, wire_format), LOCAL_DNS_ADDRESS)
+        response = receive_response(connection, transaction_id, timeout)
+        # Nothing is cached for a name that got no answer, so it is asked again next time
+        if response is not None:
+            cache_response(rr_table, hostname, response)
+
+
+def handle_batch_request(hostnames, rr_table, connection, timeout=1):
+    # Only names missing from the RR table are asked for, as many per datagram as fit
+    misses = [hostname for hostname in hostnames
+              if not rr_table.get_record(hostname) and not rr_table.is_negative(hostname)]
+    chunks = collections.deque(batch_chunks(misses))
+    while chunks:
+        chunk = chunks.popleft()
+        if len(chunk) == 1:
+            handle_request(chunk[0], rr_table, connection, timeout=timeout)
+            continue
+        transaction_id = next(transaction_ids) & 0xFFFF
+        connection.send_message(serialize_batch([{"name": hostname} for hostname in chunk], transaction_id), LOCAL_DNS_ADDRESS)
+        response = receive_response(connection, transaction_id, timeout)
+        if response is None:
+            continue
+        if response["flags"] & FLAG_TRUNCATED:
+            # The answers did not fit in one datagram: ask for each half separately
+            half = len(chunk) // 2
+            chunks.extendleft((chunk[half:], chunk[:half]))
+            continue
+        for hostname, answer in zip(chunk, response["batch"]):
+            cache_response(rr_table, hostname, answer)
+
+
+def batch_chunks(hostnames):
+    """Splits `hostnames` into lists whose batch query fits in one MAX_DATAGRAM datagram."""
+    chunk = []
+    size = WIRE_BATCH_HEADER.size
+    for hostname in hostnames:
+        question_size = WIRE_LENGTH.size + len(serialize({"name": hostname}))
+        if chunk and size + question_size > MAX_DATAGRAM:
+            yield chunk
+            chunk = []
+            size = WIRE_BATCH_HEADER.size
+        chunk.append(hostname)
+        size += question_size
+    if chunk:
+        yield chunk
+
+
+def resolve_many(hostnames, rr_table, connection, window=32, timeout=1, retries=2):
+    """
+    Resolves many hostnames over one socket, with up to `window` queries in flight.
+
+    `hostnames` may be any iterable, including a stream; names are only read as
+    the window has room. Answers come back in the order they complete and are
+    matched to their query by transaction id. A query unanswered after `timeout`
+    seconds is sent again, up to `retries` times. Uses the binary format.
+
+    Yields:
+        tuple (hostname, result): the record's result, NOT_FOUND, or TIMED_OUT.
+    """
+    names = iter(hostnames)
+    # transaction_id -> (hostname, retries left, deadline)
+    in_flight = {}
+    # (deadline, transaction_id) in the order the queries were sent
+    deadlines = collections.deque()
+
+    def send_query(hostname, retries_left):
+        transaction_id = next(transaction_ids) & 0xFFFF
+        deadline = time.monotonic() + timeout
+        in_flight[transaction_id] = (hostname, retries_left, deadline)
+        deadlines.append((deadline, transaction_id))
+        connection.send_message(serialize({"transaction_id": transaction_id, "name": hostname}), LOCAL_DNS_ADDRESS)
+
+    while True:
+        # Top the window up; cached names are answered without a query
+        while len(in_flight) < window:
+            hostname = next(names, None)
+            if hostname is None:
+                break
+            record = rr_table.get_record(hostname)
+            if record:
+                yield hostname, record['result']
+            elif rr_table.is_negative(hostname):
+                yield hostname, NOT_FOUND
+            else:
+                send_query(hostname, retries)
+        if not in_flight:
+            return
+
+        now = time.monotonic()
+        while deadlines and deadlines[0][0] <= now:
+            deadline, transaction_id = deadlines.popleft()
+            query = in_flight.get(transaction_id)
+            # Skip queries that were answered, or whose id was reused since
+            if query is None or query[2] != deadline:
+                continue
+            del in_flight[transaction_id]
+            hostname, retries_left, _ = query
+            if retries_left:
+                send_query(hostname, retries_left - 1)
+            else:
+                yield hostname, TIMED_OUT
+        if not deadlines:
+            continue
+
+        received = connection.try_receive_datagram(deadlines[0][0] - now)
+        if received is None:
+            continue
+        response = deserialize(received[0])
+        query = in_flight.pop(response["transaction_id"], None)
+        # Late answers to queries that were already retried or given up on are dropped
+        if query is None:
+            continue
+        hostname = query[0]
+        cache_response(rr_table, hostname, response)
+        yield hostname, NOT_FOUND if response["flags"] & FLAG_NOT_FOUND else response["result"]
+
+
+def resolve_stream(lines, rr_table, connection, out, window=32, timeout=1, retries=2):
+    """Resolves the whitespace-separated hostnames in `lines`, writing "hostname: result" to `out` as each completes."""
+    hostnames = (hostname for line in lines for hostname in line.split())
+    for hostname, result in resolve_many(hostnames, rr_table, connection, window, timeout, retries):
+        out.write(f"{hostname}: {result}\n")
+        out.flush()
+
+
+def receive_response(connection, transaction_id, timeout=1):
+    """
+    Waits up to `timeout` seconds for the response carrying `transaction_id`.
+
+    Returns:
+        dict: the response as a message dict, or None if it did not arrive in time.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        received = connection.try_receive_datagram(deadline - time.monotonic())
+        if received is None:
+            return None
+        response = deserialize(received[0])
+        # Skip stale answers to earlier queries
+        if response["transaction_id"] == transaction_id:
+            return response
+
+
+def cache_response(rr_table, hostname, response):
+    """Saves the answer for `hostname` in the RR table, or a negative entry if it was not found."""
+    if not response["flags"] & FLAG_NOT_FOUND:
+        rr_table.add_record(response["name"], response["type"], response["result"], response["ttl"], response["static"])
+    else:
+        rr_table.add_negative_record(hostname, NEGATIVE_TTL)
+
 
 def main():
+    parser = argparse.ArgumentParser(description="DNS client")
+    parser.add_argument("--json", dest="wire_format", action="store_const", const="json", default="binary",
+                        help="talk to the local server in the older JSON format instead of binary")
+    parser.add_argument("--batch", metavar="FILE",
+                        help="resolve the hostnames in FILE ('-' for stdin) without prompting, printing results as they complete")
+    parser.add_argument("--window", type=int, default=32,
+                        help="with --batch, the number of queries kept in flight (default 32)")
+    parser.add_argument("--timeout", type=float, default=1,
+                        help="seconds to wait for an answer (default 1); with --batch, before a query is retried")
+    parser.add_argument("--retries", type=int, default=2,
+                        help="with --batch, times a query is retried before it times out (default 2)")
+    args = parser.parse_args()
+
     rr_table = RRTable()
     connection = UDPConnection()
+    if args.batch:
+        lines = sys.stdin if args.batch == "-" else open(args.batch)
+        try:
+            resolve_stream(lines, rr_table, connection, sys.stdout, args.window, args.timeout, args.retries)
+        except KeyboardInterrupt:
+            print("Keyboard interrupt received, exiting...")
+        finally:
+            lines.close()
+            connection.close()
+        return
+
     try:
         while True:
-            input_value = input("Enter the hostname (or type 'quit' to exit) ")
+            input_value = input("Enter the hostname, or several separated by spaces (or type 'table' to show the RR table, 'quit' to exit) ")
             if input_value.lower() == "quit":
                 break
+            if input_value.lower() == "table":
+                rr_table.display_table()
+                continue
 
-            hostname = input_value
+            hostnames = input_value.split()
             query_code = DNSTypes.get_type_code("A")
             
-            handle_request(hostname, rr_table, connection)
+            # Several names on one line go out as a single batch query
+            if len(hostnames) > 1 and args.wire_format == "binary":
+                handle_batch_request(hostnames, rr_table, connection, args.timeout)
+            else:
+                for hostname in hostnames:
+                    handle_request(hostname, rr_table, connection, args.wire_format, args.timeout)
+
+            # Only the answers asked for are shown, not the whole table
+            for hostname in hostnames:
+                record = rr_table.get_record(hostname)
+                if record:
+                    print(f"{hostname}: {record['result']}")
+                else:
+                    print(f"{hostname}: {NOT_FOUND if rr_table.is_negative(hostname) else TIMED_OUT}")
 
     except KeyboardInterrupt:
         print("Keyboard interrupt received, exiting...")
@@ -42,118 +246,149 @@ def main():
         pass
 
 
-def serialize():
-    # Consider creating a serialize function
-    # This can help prepare data to send through the socket
-    pass
-
-
-def deserialize():
-    # Consider creating a deserialize function
-    # This can help prepare data that is received from the socket
-    pass
-
-
 class RRTable:
     def __init__(self):
         self.records = {
             
         }
         self.record_number = 0
+        # Secondary index: (name, type) -> record number
+        self.index = {}
+        # Min-heap of (expiry deadline, record number) for records with a ttl
+        self.expiry_heap = []
+        # Negative cache, kept apart from the records: (hostname, type) -> expiry deadline
+        self.negative = {}
+        self.negative_heap = []
         # Start the background thread
         self.lock = threading.Lock()
-        self.thread = threading.Thread(target=self.__decrement_ttl, daemon=True)
+        self.thread = threading.Thread(target=self.__expire_records, daemon=True)
         self.thread.start()
     
     def add_record(self, hostname, record_type, result, ttl, static):
         with self.lock:
-            self.records[self.record_number] = {
+            # A fresh answer replaces the old entry for the same name and type
+            old_id = self.index.get((hostname, record_type))
+            if old_id is not None:
+                del self.records[old_id]
+            record = {
                 "name": hostname,
                 "type": record_type,
                 "result": result,
-                "ttl": ttl,
+                # Absolute monotonic deadline; static records never expire
+                "expires": None if ttl in (None, "None") else time.monotonic() + ttl,
                 "static" : static
             }
+            if record["expires"] is not None:
+                heapq.heappush(self.expiry_heap, (record["expires"], self.record_number))
+            self.records[self.record_number] = record
+            self.index[(hostname, record_type)] = self.record_number
             self.record_number += 1
+            # The name exists now, so forget any earlier "Record Not Found"
+            self.negative.pop((hostname, record_type), None)
+            self.negative.pop((hostname, None), None)
 
-    def get_record(self, hostname):
+    def add_negative_record(self, hostname, ttl, record_type=None):
+        """Remembers for `ttl` seconds that `hostname` has no record of `record_type` (None: any type)."""
         with self.lock:
-            for record_id, record in self.records.items():
-                if(record["name"] == hostname):
+            expires = time.monotonic() + ttl
+            self.negative[(hostname, record_type)] = expires
+            heapq.heappush(self.negative_heap, (expires, hostname, record_type or ""))
+
+    def is_negative(self, hostname, record_type=None):
+        """True if the lookup is cached as not found and that answer has not expired."""
+        with self.lock:
+            expires = self.negative.get((hostname, record_type))
+            if expires is None:
+                return False
+            if expires <= time.monotonic():
+                del self.negative[(hostname, record_type)]
+                return False
+            return True
+
+    def get_record(self, hostname, record_type=None):
+        """
+        Looks up a record by hostname and optionally type.
+
+        Returns a copy of the record with "ttl" set to the remaining lifetime
+        in seconds, or None. Expired records are evicted on the way.
+        """
+        with self.lock:
+            now = time.monotonic()
+            if record_type is not None:
+                return self.__live_record(self.index.get((hostname, record_type)), now)
+            # No type given: try each known type, still constant-time
+            for type_name in DNSTypes.name_to_code:
+                record = self.__live_record(self.index.get((hostname, type_name)), now)
+                if record:
                     return record
         return None
 
-    def display_table(self):
+    def remove_record(self, hostname, record_type):
         with self.lock:
-            # Display the table in the following format (include the column names):
-            # record_number,name,type,result,ttl,static
-            #print(f"{'record_number':<15}{'name':<20}{'type':<10}{'result':<30}{'ttl':<6}{'static':<6}")
-            #print('-' * 90)
-            
-            print("record_no,name,type,result,ttl,static")
-            for record_id, record in self.records.items():
-                 #print(f"{record_id:<15}{record['name']:<20}{record['type']:<10}{record['result']:<30}{record['ttl']:<6}{record['static']:<6}")
-                 thing = str(record_id) + "," + str(record['name']) + "," + str(record['type']) + "," + str(record['result']) + "," + str(record['ttl']) + "," + str(record['static'])
-                 print(thing)
+            record_id = self.index.pop((hostname, record_type), None)
+            if record_id is not None:
+                del self.records[record_id]
 
-    def __decrement_ttl(self):
+    def display_table(self, out=None):
+        """Writes the table to `out` (stdout by default). The lock is only held while the rows are copied."""
+        with self.lock:
+            records = list(self.records.values())
+        # Display the table in the following format (include the column names):
+        # record_number,name,type,result,ttl,static
+        now = time.monotonic()
+        lines = ["record_no,name,type,result,ttl,static"]
+        for record_no, record in enumerate(records):
+            lines.append(f"{record_no},{record['name']},{record['type']},{record['result']},{self.__remaining_ttl(record, now)},{record['static']}")
+        (out or sys.stdout).write("\n".join(lines) + "\n")
+
+    def __remaining_ttl(self, record, now):
+        # Static records have no deadline and keep their "None" ttl
+        if record['expires'] is None:
+            return "None"
+        return max(0, math.ceil(record['expires'] - now))
+
+    def __live_record(self, record_id, now):
+        # This method is only called within a locked context
+        if record_id is None:
+            return None
+        record = self.records[record_id]
+        if record['expires'] is not None and record['expires'] <= now:
+            # Lazily evict; the heap entry is skipped when the sweep reaches it
+            del self.records[record_id]
+            del self.index[(record['name'], record['type'])]
+            return None
+        return {
+            "name": record['name'],
+            "type": record['type'],
+            "result": record['result'],
+            "ttl": self.__remaining_ttl(record, now),
+            "static": record['static']
+        }
+
+    def __expire_records(self):
         while True:
             with self.lock:
-                # Decrement ttl
-                for record_id, record in self.records.items():
-                    if record['ttl'] > 0:
-                        record['ttl'] -= 1
-                self.__remove_expired_records()
+                self.__remove_expired_records(time.monotonic())
             time.sleep(1)
 
-    def __remove_expired_records(self):
+    def __remove_expired_records(self, now):
         # This method is only called within a locked context
-        # Remove expired records
-        expired_keys = [key for key, record in self.records.items() if record['ttl'] != "None" and record['ttl'] <= 0]
-        for key in expired_keys:
-            del self.records[key]
-        # Update record numbers
-        new_record_number = 0
-        new_records = {}
-        
-        for key, record in sorted(self.records.items()):
-            record['record_number'] = new_record_number
-            new_records[new_record_number] = record
-            new_record_number += 1
-        
-        self.records = new_records
-        self.record_number = new_record_number
-
-
-class DNSTypes:
-    """
-    A class to manage DNS query types and their corresponding codes.
-
-    Examples:
-    >>> DNSTypes.get_type_code('A')
-    8
-    >>> DNSTypes.get_type_name(0b0100)
-    'AAAA'
-    """
-
-    name_to_code = {
-        "A": 0b1000,
-        "AAAA": 0b0100,
-        "CNAME": 0b0010,
-        "NS": 0b0001,
-    }
-
-    code_to_name = {code: name for name, code in name_to_code.items()}
 
-    @staticmethod
-    def get_type_code(type_name: str):
-        """Gets the code for the given DNS query type name, or None"""
-        return DNSTypes.name_to_code.get(type_name, None)
+        # Reclaims expired records nobody has read since they expired.
+        # Only pop records whose deadline has passed; the rest of the table is untouched
+        while self.expiry_heap and self.expiry_heap[0][0] <= now:
+            expires, record_id = heapq.heappop(self.expiry_heap)
+            record = self.records.get(record_id)
+            # Skip heap entries left behind by replaced or removed records
+            if record is not None and record['expires'] == expires:
+                del self.records[record_id]
+                del self.index[(record['name'], record['type'])]
 
-    @staticmethod
-    def get_type_name(type_code: int):
-        """Gets the DNS query type name for the given code, or None"""
-        return DNSTypes.code_to_name.get(type_code, None)
+        while self.negative_heap and self.negative_heap[0][0] <= now:
+            expires, hostname, record_type = heapq.heappop(self.negative_heap)
+            key = (hostname, record_type or None)
+            if self.negative.get(key) == expires:
+                del self.negative[key]
 
 
 class UDPConnection:
@@ -162,27 +397,42 @@ class UDPConnection:
     def __init__(self, timeout: int = 1):
         """Initializes the UDPConnection instance with a timeout. Defaults to 1."""
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.timeout = timeout
         self.socket.settimeout(timeout)
         self.is_bound = False
 
-    def send_message(self, message: str, address: tuple[str, int]):
-        """Sends a message to the specified address."""
-        self.socket.sendto(message.encode(), address)
+    def send_message(self, message: str | bytes, address: tuple[str, int]):
+        """Sends a message to the specified address. Strings are UTF-8 encoded first."""
+        if isinstance(message, str):
+            message = message.encode()
+        self.socket.sendto(message, address)
 
     def receive_message(self):
         """
-        Receives a message from the socket.
+        Receives a text message from the socket.
 
         Returns:
             tuple (data, address): The received message and the address it came from.
 
+        Raises:
+            KeyboardInterrupt: If the program is interrupted manually.
+        """
+        data, address = self.receive_datagram()
+        return data.decode(), address
+
+    def receive_datagram(self):
+        """
+        Receives a raw datagram from the socket, for the binary wire format.
+
+        Returns:
+            tuple (data, address): The received bytes and the address they came from.
+
         Raises:
             KeyboardInterrupt: If the program is interrupted manually.
         """
         while True:
             try:
-                data, address = self.socket.recvfrom(4096)
-                return data.decode(), address
+                return self.socket.recvfrom(MAX_DATAGRAM)
             except socket.timeout:
                 continue
             except OSError as e:
@@ -195,6 +445,21 @@ class UDPConnection:
             except KeyboardInterrupt:
                 raise
 
+    def try_receive_datagram(self, timeout: float):
+        """
+        Waits at most `timeout` seconds for a raw datagram.
+
+        Returns:
+            tuple (data, address), or None if nothing arrived in time.
+        """
+        self.socket.settimeout(max(timeout, 0.001))
+        try:
+            return self.socket.recvfrom(MAX_DATAGRAM)
+        except socket.timeout:
+            return None
+        finally:
+            self.socket.settimeout(self.timeout)
+
     def bind(self, address: tuple[str, int]):
         """Binds the socket to the given address. This means it will be a server."""
         if self.is_bound:
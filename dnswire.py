@@ -0,0 +1,434 @@
+import json
+import socket
+import struct
+import time
+
+# Binary wire format, version 1, all integers in network byte order:
+#   version:u8 flags:u8 transaction_id:u16 type_code:u8 ttl:u32 static:u8
+#   name_length:u16 name result_length:u16 result
+# A batch (FLAG_BATCH) is version:u8 flags:u8 transaction_id:u16 count:u16 followed by
+# count length-prefixed messages in the format above. The older formats have no batches.
+# A batch query and its response must each fit in MAX_DATAGRAM bytes; a response that
+# would not is sent as FLAG_TRUNCATED with no answers, and is asked for again in parts.
+# Datagrams that do not start with WIRE_VERSION are read as the older JSON/text format.
+WIRE_VERSION = 1
+FLAG_RESPONSE = 0b01
+FLAG_NOT_FOUND = 0b10
+FLAG_BATCH = 0b100
+FLAG_TRUNCATED = 0b1000
+# ttl value meaning "no ttl"
+NO_TTL = 0xFFFFFFFF
+WIRE_HEADER = struct.Struct("!BBHBIB")
+WIRE_LENGTH = struct.Struct("!H")
+WIRE_BATCH_HEADER = struct.Struct("!BBHH")
+# Size of every receive buffer, so the largest datagram either side takes
+MAX_DATAGRAM = 4096
+NOT_FOUND = "Record Not Found"
+# What deserialize() raises for a truncated or garbled datagram; RecursionError is deeply nested JSON
+MALFORMED_DATAGRAM_ERRORS = (struct.error, IndexError, ValueError, UnicodeDecodeError, RecursionError)
+# Seconds between two lines about dropped datagrams, so a flood of junk does not flood the log too
+DROP_REPORT_INTERVAL = 10
+
+
+def serialize(message, wire_format="binary"):
+    """
+    Packs a message dict into bytes for the socket.
+
+    The dict has the keys transaction_id, flags, name, type, result, ttl and static
+    (missing ones default to empty). wire_format "json" produces the older JSON/text
+    format instead, for peers that do not speak the binary one; "rfc1035" produces a
+    standard DNS packet.
+    """
+    if wire_format == "json":
+        return serialize_json(message).encode()
+    if wire_format == "rfc1035":
+        return serialize_rfc1035(message)
+    name = message["name"].encode()
+    result = (message.get("result") or "").encode()
+    ttl = message.get("ttl")
+    header = WIRE_HEADER.pack(
+        WIRE_VERSION,
+        message.get("flags", 0),
+        message.get("transaction_id") or 0,
+        DNSTypes.get_type_code(message.get("type")) or 0,
+        NO_TTL if ttl in (None, "None") else ttl,
+        message.get("static", 0),
+    )
+    return b"".join((header, WIRE_LENGTH.pack(len(name)), name, WIRE_LENGTH.pack(len(result)), result))
+
+
+def deserialize(data, rfc1035=False):
+    """
+    Unpacks a received datagram, binary or older JSON/text format, into a message dict.
+
+    RFC 1035 packets cannot be told apart from the binary format, so they are only
+    parsed when rfc1035 is set.
+    """
+    if rfc1035:
+        return deserialize_rfc1035(data)
+    if data[:1] != bytes((WIRE_VERSION,)):
+        return deserialize_json(str(data, "utf-8"))
+    if len(data) > 1 and data[1] & FLAG_BATCH:
+        return deserialize_batch(data)
+    _, flags, transaction_id, type_code, ttl, static = WIRE_HEADER.unpack_from(data)
+    name, offset = read_wire_string(data, WIRE_HEADER.size)
+    result, _ = read_wire_string(data, offset)
+    return {
+        "format": "binary",
+        "transaction_id": transaction_id,
+        "flags": flags,
+        "name": name,
+        "type": DNSTypes.get_type_name(type_code),
+        "result": result or None,
+        "ttl": None if ttl == NO_TTL else ttl,
+        "static": static
+    }
+
+
+def read_wire_string(data, offset):
+    """
+    Reads the length-prefixed string at `offset`. Returns (text, offset after it).
+
+    Raises:
+        struct.error, ValueError: If the datagram ends before the string does.
+    """
+    (length,) = WIRE_LENGTH.unpack_from(data, offset)
+    offset += WIRE_LENGTH.size
+    if offset + length > len(data):
+        raise ValueError(f"string of {length} bytes runs past the end of the datagram")
+    return str(data[offset:offset + length], "utf-8"), offset + length
+
+
+def serialize_batch(messages, transaction_id=0, flags=0):
+    """Packs several messages into one binary batch datagram."""
+    parts = [WIRE_BATCH_HEADER.pack(WIRE_VERSION, flags | FLAG_BATCH, transaction_id, len(messages))]
+    for message in messages:
+        packed = serialize(message)
+        parts.append(WIRE_LENGTH.pack(len(packed)))
+        parts.append(packed)
+    return b"".join(parts)
+
+
+def deserialize_batch(data):
+    """
+    Unpacks a binary batch datagram; the messages are in the "batch" list of the result.
+
+    Raises:
+        ValueError: If a message runs past the end of the datagram, is itself a batch,
+            or has no name.
+    """
+    _, flags, transaction_id, count = WIRE_BATCH_HEADER.unpack_from(data)
+    offset = WIRE_BATCH_HEADER.size
+    batch = []
+    for _ in range(count):
+        (length,) = WIRE_LENGTH.unpack_from(data, offset)
+        offset += WIRE_LENGTH.size
+        if offset + length > len(data):
+            raise ValueError(f"batch message of {length} bytes runs past the end of the datagram")
+        if length > 1 and data[offset] == WIRE_VERSION and data[offset + 1] & FLAG_BATCH:
+            raise ValueError("batches cannot be nested")
+        message = deserialize(data[offset:offset + length])
+        if not isinstance(message.get("name"), str) or not message["name"]:
+            raise ValueError("batch message has no name")
+        batch.append(message)
+        offset += length
+    return {
+        "format": "binary",
+        "transaction_id": transaction_id,
+        "flags": flags,
+        "batch": batch
+    }
+
+
+def serialize_json(message):
+    """
+    Builds the older text format: a bare hostname query, a JSON record list or
+    "Record Not Found", wrapped as [transaction_id, text] when the message carries an id.
+    """
+    if not message.get("flags", 0) & FLAG_RESPONSE:
+        text = message["name"]
+    elif message["flags"] & FLAG_NOT_FOUND:
+        text = NOT_FOUND
+    else:
+        text = json.dumps([message["name"], message["type"], message["result"], message["ttl"], message["static"]])
+    if message.get("transaction_id") is not None:
+        text = json.dumps([message["transaction_id"], text])
+    return text
+
+
+def deserialize_json(text):
+    """Parses the older text format into the same message dict deserialize() returns."""
+    message = {
+        "format": "json",
+        "transaction_id": None,
+        "flags": 0,
+        "name": None,
+        "type": None,
+        "result": None,
+        "ttl": None,
+        "static": 0
+    }
+    if text.startswith("["):
+        value = json.loads(text)
+        if not isinstance(value, list) or len(value) not in (2, 5):
+            raise ValueError(f"expected a tagged message or a record, got {text!r}")
+        if len(value) == 2:
+            if not isinstance(value[1], str):
+                raise ValueError(f"tagged message is not text: {text!r}")
+            # Tagged message: [transaction_id, text]
+            message = deserialize_json(value[1])
+            message["transaction_id"] = value[0]
+            return message
+        name, record_type, result, ttl, static = value
+        if not all(isinstance(field, str) for field in (name, record_type, result)):
+            raise ValueError(f"record name, type and result must be text: {text!r}")
+        if ttl not in (None, "None") and (type(ttl) is not int or not 0 <= ttl < NO_TTL):
+            raise ValueError(f"record ttl must be a number of seconds: {text!r}")
+        if static not in (0, 1):
+            raise ValueError(f"record static flag must be 0 or 1: {text!r}")
+        message["name"], message["type"], message["result"], message["ttl"], message["static"] = value
+        message["flags"] = FLAG_RESPONSE
+    elif text == NOT_FOUND:
+        message["flags"] = FLAG_RESPONSE | FLAG_NOT_FOUND
+    else:
+        message["name"] = text
+    return message
+
+
+def build_response(request, name, record_type=None, result=None, ttl=None, rfc1035_rcode=None):
+    """
+    Builds the reply to `request`, echoing its transaction id and wire format. No result means not found.
+
+    rfc1035_rcode replaces NXDOMAIN in an RFC 1035 not-found answer, e.g. NOERROR for NODATA.
+    """
+    flags = FLAG_RESPONSE if result is not None else FLAG_RESPONSE | FLAG_NOT_FOUND
+    return serialize({
+        "transaction_id": request["transaction_id"],
+        "flags": flags,
+        "name": name,
+        "type": record_type,
+        "result": result,
+        "ttl": ttl,
+        "static": 0,
+        # Only present on RFC 1035 queries, which the answer has to echo
+        "question": request.get("question"),
+        "rfc1035_flags": request.get("rfc1035_flags", 0),
+        "rfc1035_rcode": rfc1035_rcode
+    }, request["format"])
+
+
+def build_batch_response(request, answers):
+    """Builds the reply to a batch query from one (name, type, result, ttl) answer per question."""
+    response = serialize_batch([{
+        "flags": FLAG_RESPONSE if result is not None else FLAG_RESPONSE | FLAG_NOT_FOUND,
+        "name": name,
+        "type": record_type,
+        "result": result,
+        "ttl": ttl
+    } for name, record_type, result, ttl in answers], request["transaction_id"], FLAG_RESPONSE)
+    if len(response) > MAX_DATAGRAM:
+        # It would be cut off in the client's receive buffer; the client splits the batch instead
+        return serialize_batch([], request["transaction_id"], FLAG_RESPONSE | FLAG_TRUNCATED)
+    return response
+
+
+# RFC 1035 packets, for the --rfc1035 mode that standard DNS tools can talk to
+RFC1035_HEADER = struct.Struct("!HHHHHH")
+RFC1035_QUESTION = struct.Struct("!HH")
+RFC1035_ANSWER = struct.Struct("!HHIH")
+RFC1035_TYPES = {"A": 1, "NS": 2, "CNAME": 5, "AAAA": 28}
+RFC1035_TYPE_NAMES = {code: name for name, code in RFC1035_TYPES.items()}
+# QTYPE "*": our "any type" lookup
+RFC1035_ANY = 255
+RFC1035_QR = 0x8000
+RFC1035_RD = 0x0100
+RFC1035_RA = 0x0080
+RFC1035_RCODE = 0x000F
+RFC1035_NOERROR = 0
+RFC1035_NXDOMAIN = 3
+RFC1035_NOTIMP = 4
+
+
+def encode_name(name):
+    """Encodes a hostname as a sequence of length-prefixed labels."""
+    labels = [label.encode() for label in name.rstrip(".").split(".") if label]
+    return b"".join(bytes((len(label),)) + label for label in labels) + b"\0"
+
+
+def decode_name(data, offset):
+    """
+    Decodes a (possibly compressed) name at `offset`. Returns (name, offset after it).
+
+    Raises:
+        ValueError: If the name runs past the end of the packet, or a compression
+            pointer does not point before the part of the name it continues.
+    """
+    labels = []
+    end = None
+    # Every pointer has to jump before the start of the previous part, so a name cannot loop
+    start = offset
+    while True:
+        if offset >= len(data):
+            raise ValueError("name runs past the end of the packet")
+        length = data[offset]
+        if length & 0xC0 == 0xC0:
+            # Compression pointer: the rest of the name is elsewhere in the packet
+            if offset + 1 >= len(data):
+                raise ValueError("name runs past the end of the packet")
+            pointer = ((length & 0x3F) << 8) | data[offset + 1]
+            if pointer >= start:
+                raise ValueError(f"compression pointer to {pointer} does not point backwards")
+            if end is None:
+                end = offset + 2
+            offset = start = pointer
+            continue
+        if length & 0xC0:
+            raise ValueError(f"unsupported label type {length >> 6}")
+        offset += 1
+        if length == 0:
+            break
+        if offset + length > len(data):
+            raise ValueError("label runs past the end of the packet")
+        labels.append(str(data[offset:offset + length], "utf-8"))
+        offset += length
+    return ".".join(labels), end if end is not None else offset
+
+
+def serialize_rfc1035(message):
+    """Builds an RFC 1035 query, or a response with at most one answer RR."""
+    record_type = message.get("type")
+    if not message.get("flags", 0) & FLAG_RESPONSE:
+        question = encode_name(message["name"]) + RFC1035_QUESTION.pack(RFC1035_TYPES.get(record_type, RFC1035_ANY), 1)
+        header = RFC1035_HEADER.pack(message.get("transaction_id") or 0, RFC1035_RD, 1, 0, 0, 0)
+        return header + question
+
+    # Echo the question and the RD bit of the query being answered
+    question = message.get("question") or encode_name(message["name"]) + RFC1035_QUESTION.pack(RFC1035_ANY, 1)
+    flags = RFC1035_QR | RFC1035_RA | (message.get("rfc1035_flags", 0) & RFC1035_RD)
+    if message["flags"] & FLAG_NOT_FOUND:
+        # NOERROR with no answer is NODATA: the name exists, just not with the asked type
+        rcode = message.get("rfc1035_rcode")
+        rcode = RFC1035_NXDOMAIN if rcode is None else rcode
+        header = RFC1035_HEADER.pack(message.get("transaction_id") or 0, flags | rcode, 1, 0, 0, 0)
+        return header + question
+
+    result = message["result"]
+    if record_type == "A":
+        rdata = socket.inet_pton(socket.AF_INET, result)
+    elif record_type == "AAAA":
+        rdata = socket.inet_pton(socket.AF_INET6, result)
+    else:
+        rdata = encode_name(result)
+    ttl = message.get("ttl")
+    header = RFC1035_HEADER.pack(message.get("transaction_id") or 0, flags, 1, 1, 0, 0)
+    # 0xC00C points the answer's owner name at the question name right after the header
+    answer = b"\xc0\x0c" + RFC1035_ANSWER.pack(
+        RFC1035_TYPES[record_type], 1, 0 if ttl in (None, "None") else ttl, len(rdata)
+    ) + rdata
+    return header + question + answer
+
+
+def deserialize_rfc1035(data):
+    """Parses an RFC 1035 packet into a message dict; only the question and first answer are read."""
+    transaction_id, rfc1035_flags, qdcount, ancount, _, _ = RFC1035_HEADER.unpack_from(data)
+    offset = RFC1035_HEADER.size
+    name, offset = decode_name(data, offset)
+    qtype, _ = RFC1035_QUESTION.unpack_from(data, offset)
+    offset += RFC1035_QUESTION.size
+    message = {
+        "format": "rfc1035",
+        "transaction_id": transaction_id,
+        "flags": 0,
+        "name": name,
+        "type": RFC1035_TYPE_NAMES.get(qtype),
+        "result": None,
+        "ttl": None,
+        "static": 0,
+        # Copied, since data may be a view into a reused receive buffer
+        "question": bytes(data[RFC1035_HEADER.size:offset]),
+        "rfc1035_flags": rfc1035_flags
+    }
+    if not rfc1035_flags & RFC1035_QR:
+        # Only the types the tables store can be looked up; None (any type) is for QTYPE "*" alone
+        message["unsupported_type"] = qtype != RFC1035_ANY and qtype not in RFC1035_TYPE_NAMES
+        return message
+
+    message["flags"] = FLAG_RESPONSE
+    if ancount == 0 or rfc1035_flags & RFC1035_RCODE:
+        message["flags"] |= FLAG_NOT_FOUND
+        message["rfc1035_rcode"] = rfc1035_flags & RFC1035_RCODE
+        return message
+    message["name"], offset = decode_name(data, offset)
+    rr_type, _, message["ttl"], rdlength = RFC1035_ANSWER.unpack_from(data, offset)
+    offset += RFC1035_ANSWER.size
+    message["type"] = RFC1035_TYPE_NAMES.get(rr_type)
+    if message["type"] == "A":
+        message["result"] = socket.inet_ntop(socket.AF_INET, data[offset:offset + rdlength])
+    elif message["type"] == "AAAA":
+        message["result"] = socket.inet_ntop(socket.AF_INET6, data[offset:offset + rdlength])
+    else:
+        message["result"], _ = decode_name(data, offset)
+    return message
+
+
+class DropReport:
+    """
+    Counts datagrams a server drops, printing at most one line about them every `interval` seconds.
+
+    Examples:
+    >>> drops = DropReport()
+    >>> drops.drop(("127.0.0.1", 5300), "not a query")
+    Dropped malformed datagram from ('127.0.0.1', 5300): not a query
+    >>> drops.drop(("127.0.0.1", 5300), "not a query")
+    >>> drops.dropped
+    2
+    """
+
+    def __init__(self, interval: float = DROP_REPORT_INTERVAL):
+        self.interval = interval
+        self.dropped = 0
+        self.reported = 0
+        self.next_report = 0.0
+
+    def drop(self, address, reason):
+        """Counts one dropped datagram; `reason` is the error or text saying why."""
+        self.dropped += 1
+        now = time.monotonic()
+        if now < self.next_report:
+            return
+        unreported = self.dropped - self.reported - 1
+        since = f" ({unreported} more dropped since the last report)" if unreported else ""
+        print(f"Dropped malformed datagram from {address}: {reason}{since}")
+        self.reported = self.dropped
+        self.next_report = now + self.interval
+
+
+class DNSTypes:
+    """
+    A class to manage DNS query types and their corresponding codes.
+
+    Examples:
+    >>> DNSTypes.get_type_code('A')
+    8
+    >>> DNSTypes.get_type_name(0b0100)
+    'AAAA'
+    """
+
+    name_to_code = {
+        "A": 0b1000,
+        "AAAA": 0b0100,
+        "CNAME": 0b0010,
+        "NS": 0b0001,
+    }
+
+    code_to_name = {code: name for name, code in name_to_code.items()}
+
+    @staticmethod
+    def get_type_code(type_name: str):
+        """Gets the code for the given DNS query type name, or None"""
+        return DNSTypes.name_to_code.get(type_name, None)
+
+    @staticmethod
+    def get_type_name(type_code: int):
+        """Gets the DNS query type name for the given code, or None"""
+        return DNSTypes.code_to_name.get(type_code, None)
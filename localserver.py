@@ -1,226 +1,1298 @@
-import errno
+import argparse
+import array
+import asyncio
+import collections
+import heapq
+import itertools
+import math
+import os
+import selectors
+import signal
 import socket
+import struct
 import sys
+import tempfile
 import threading
 import time
 import json
 
-def listen(rr_table, connection):
+from dnswire import (
+    DNSTypes, DropReport, FLAG_NOT_FOUND, FLAG_RESPONSE, MALFORMED_DATAGRAM_ERRORS, MAX_DATAGRAM, RFC1035_NOTIMP,
+    RFC1035_NXDOMAIN, WIRE_LENGTH, build_batch_response, build_response, deserialize, serialize
+)
+
+# TTL handed to clients for static records, which never expire locally
+DEFAULT_TTL = 60
+# How long a "Record Not Found" answer is cached
+NEGATIVE_TTL = 30
+# A record hit this many times is refreshed from upstream once it enters the last
+# PREFETCH_FRACTION of its ttl, so popular names never drop out of the cache
+PREFETCH_MIN_HITS = 3
+PREFETCH_FRACTION = 0.1
+# Waiter of a refresh-ahead query: nobody is waiting for its answer
+PREFETCH = (None, None)
+# TTL of an expired record served while the authoritative server is failing (RFC 8767)
+STALE_TTL = 30
+# When sending a query to the authoritative DNS server, use port 22000
+AMAZONE_DNS_ADDRESS = ("127.0.0.1", 22000)
+# Querying this name returns the server's metrics as JSON instead of a record
+STATS_NAME = "stats.localserver"
+
+# Cache snapshot file, all integers in network byte order:
+#   header: magic:4s version:u8 pad:3 record_count:u32
+#   records: flags:u8 expires:f64 lifetime:f64 hits:u32 key_length:u16 key ("type name"),
+#            then a packed IPv4 address:u32 if flags has SNAPSHOT_IPV4, a packed IPv6 address:16s
+#            if flags has SNAPSHOT_IPV6, else result_length:u16 result.
+# expires is wall-clock (time.time()) time, since monotonic time does not survive a restart.
+SNAPSHOT_MAGIC = b"LSNP"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("!4sBxxxI")
+SNAPSHOT_RECORD = struct.Struct("!BddIH")
+SNAPSHOT_IPV4 = 0b01
+SNAPSHOT_IPV6 = 0b10
+
+
+def handle_message(rr_table, pending, metrics, data, connection_addr, send, rfc1035=False):
+    """
+    Handles one datagram: either a client query or an answer from the authoritative server.
+
+    `send(message, address)` is used for every reply, so the same logic serves both
+    the blocking loop in listen() and the asyncio protocol. Clients are answered in
+    the wire format they asked in; the authoritative server is asked in binary, or
+    with RFC 1035 packets when rfc1035 is set (every datagram is then RFC 1035).
+    """
+    expire_pending(rr_table, pending, metrics, send, rfc1035)
     try:
-        while True:
-            # Wait for query
-            request, connection_addr = connection.receive_message()
-            #print(f"Localserver: Recieved Request for {request} from {connection_addr}")
-            
-            # Check RR table for record
-            record = rr_table.get_record(request)
-            if record:
-                #print(f"LocalServer: Record found for {request}")
-                response = [record['name'], record['type'], record['result'], 60, 0]
-                responsepack = json.dumps(response)
-                connection.send_message(responsepack, connection_addr)
-            # If not found, ask the authoritative DNS server of the requested hostname/domain
-            
-            # This means parsing the query to get the domain (e.g. amazone.com from shop.amazone.com)
-            # With the domain, you can do a self lookup to get the NS record of the domain (e.g. dns.amazone.com)
-            # With the server name, you can do a self lookup to get the IP address (e.g. 127.0.0.1)
-
-            # When sending a query to the authoritative DNS server, use port 22000
-            else:
-                #print(f"record not found for {request}. Asking authoritiative DNS server...")
-                amazone_dns_address = ("127.0.0.1", 22000)
-                connection.send_message(request, amazone_dns_address)
-                response, addr = connection.receive_message()
-                responseunpack = json.loads(response)
-                if(responseunpack != "Record Not Found"):
-                    rr_table.add_record(responseunpack[0], responseunpack[1], responseunpack[2], responseunpack[3], responseunpack[4])
-                    connection.send_message(response, connection_addr)
-                else:
-                    #print(f"record not found")
-                    connection.send_message(response, connection_addr)
-            # Then save the record if valid
-            # Else, add "Record not found" in the DNS response
-            
-            # The format of the DNS query and response is in the project description
-            
-            # Display RR table
-            rr_table.display_table()
+        message = deserialize(data, rfc1035)
+    except MALFORMED_DATAGRAM_ERRORS as e:
+        # One bad datagram must not take the server down; it is dropped
+        metrics.drop(connection_addr, e)
+        return
+
+    if connection_addr == AMAZONE_DNS_ADDRESS:
+        # Answer from the authoritative server: match it back to the clients that asked
+        if "batch" in message or not message["flags"] & FLAG_RESPONSE:
+            metrics.drop(connection_addr, "not an answer")
+            return
+        sent_at = pending.sent_at(message["transaction_id"])
+        query = pending.pop(message["transaction_id"])
+        if query is None:
+            # Late or duplicate answer for a query we already gave up on
+            return
+        metrics.observe("upstream", time.monotonic() - sent_at)
+        (hostname, record_type), waiters = query
+        # Then save the record if valid
+        # Else, "Record not found" is passed on in the DNS response
+        if message["flags"] & FLAG_NOT_FOUND:
+            rcode = message.get("rfc1035_rcode")
+            # Only names that do not exist are cached; NODATA and failures are asked again
+            if rcode in (None, RFC1035_NXDOMAIN):
+                rr_table.add_negative_record(hostname, NEGATIVE_TTL, record_type)
+            metrics.count("negative", len([waiter for waiter in waiters if waiter is not PREFETCH]))
+            for waiter in waiters:
+                answer_waiter(waiter, send, hostname, rfc1035_rcode=rcode)
+        else:
+            rr_table.add_record(message["name"], message["type"], message["result"], message["ttl"], message["static"])
+            for waiter in waiters:
+                answer_waiter(waiter, send, message["name"], message["type"], message["result"], message["ttl"])
+        return
+
+    # Clients only send queries; a response or a nameless message cannot be answered
+    if message["flags"] & FLAG_RESPONSE or "batch" not in message and not message["name"]:
+        metrics.drop(connection_addr, "not a query")
+        return
+
+    if "batch" in message:
+        # Cached names are answered straight away; only the misses go upstream
+        if not message["batch"]:
+            send(build_batch_response(message, []), connection_addr)
+            return
+        batch = BatchQuery(message, connection_addr)
+        for index, question in enumerate(message["batch"]):
+            resolve(rr_table, pending, metrics, question, (batch, index), send, rfc1035)
+        return
+
+    # Answering another type as "any type" would hand out an RR of the wrong type
+    if message.get("unsupported_type"):
+        send(build_response(message, message["name"], rfc1035_rcode=RFC1035_NOTIMP), connection_addr)
+        return
+
+    # RFC 1035 has no record type to carry the JSON in, so stats are only served in our formats
+    if message["name"] == STATS_NAME and message["format"] != "rfc1035":
+        send(build_response(message, STATS_NAME, result=json.dumps(metrics.snapshot()), ttl=0), connection_addr)
+        return
+
+    resolve(rr_table, pending, metrics, message, (connection_addr, message), send, rfc1035)
+
+
+def resolve(rr_table, pending, metrics, message, waiter, send, rfc1035=False):
+    """Answers one question from the cache, or forwards it upstream with `waiter` waiting on the answer."""
+    hostname = message["name"]
+    record_type = message["type"]
+    #print(f"Localserver: Recieved Request for {hostname}")
+    metrics.count("queries")
+    
+    # Check RR table for record
+    started = time.perf_counter()
+    record = rr_table.get_record(hostname, record_type)
+    negative = not record and rr_table.is_negative(hostname, record_type)
+    metrics.observe("lookup", time.perf_counter() - started)
+    if record:
+        #print(f"LocalServer: Record found for {hostname}")
+        metrics.count("hits")
+        # Pass on the remaining ttl so downstream caches expire with ours
+        ttl = record['ttl'] if record['ttl'] != "None" else DEFAULT_TTL
+        answer_waiter(waiter, send, record['name'], record['type'], record['result'], ttl)
+        if should_prefetch(record) and not pending.in_flight((hostname, record_type)):
+            # Refresh ahead: the answer replaces the record before it expires
+            metrics.count("prefetches")
+            ask_upstream(pending, PREFETCH, (hostname, record_type), send, rfc1035)
+    # Known not to exist: answer locally until the negative entry expires
+    elif negative:
+        metrics.count("hits")
+        metrics.count("negative")
+        answer_waiter(waiter, send, hostname)
+    # If not found, ask the authoritative DNS server of the requested hostname/domain
+    
+    # This means parsing the query to get the domain (e.g. amazone.com from shop.amazone.com)
+    # With the domain, you can do a self lookup to get the NS record of the domain (e.g. dns.amazone.com)
+    # With the server name, you can do a self lookup to get the IP address (e.g. 127.0.0.1)
+
+    # The query is tagged with a transaction id and we go straight back to serving
+    # other clients; the answer is handled when it arrives on this same socket.
+    # If the name is already being looked up, the client just waits on that answer.
+    else:
+        #print(f"record not found for {hostname}. Asking authoritiative DNS server...")
+        metrics.count("misses")
+        # Upstream is already over budget on this name: do not queue behind it
+        if pending.is_overdue((hostname, record_type)) and serve_stale(rr_table, metrics, (hostname, record_type), [waiter], send):
+            return
+        if ask_upstream(pending, waiter, (hostname, record_type), send, rfc1035):
+            metrics.count("forwards")
+    
+    # The format of the DNS query and response is in the project description
+
+
+def ask_upstream(pending, waiter, key, send, rfc1035=False):
+    """Makes `waiter` wait on the answer for the (hostname, type) `key`. Returns True if a query had to be sent."""
+    transaction_id, is_new = pending.add(waiter, key)
+    if transaction_id is None:
+        # No transaction id is free: fail like a timed-out query instead of waiting for one
+        answer_waiter(waiter, send, *key)
+        return False
+    if is_new:
+        query = {"transaction_id": transaction_id, "name": key[0], "type": key[1]}
+        send(serialize(query, "rfc1035" if rfc1035 else "binary"), AMAZONE_DNS_ADDRESS)
+    return is_new
+
+
+def serve_stale(rr_table, metrics, key, waiters, send):
+    """
+    Answers `waiters` with the expired record for `key`, if it is still within the
+    stale window. The waiters are removed from the list. Returns False if there is none.
+    """
+    record = rr_table.get_stale_record(*key)
+    if record is None:
+        return False
+    for waiter in waiters:
+        if waiter is not PREFETCH:
+            metrics.count("stale")
+            answer_waiter(waiter, send, record['name'], record['type'], record['result'], STALE_TTL)
+    waiters.clear()
+    return True
+
+
+def should_prefetch(record):
+    """True if a cached record is popular and close enough to expiring to be refreshed now."""
+    return (
+        record['lifetime'] is not None
+        and record['hits'] >= PREFETCH_MIN_HITS
+        and record['expires'] - time.monotonic() <= record['lifetime'] * PREFETCH_FRACTION
+    )
+
+
+def expire_pending(rr_table, pending, metrics, send, rfc1035=False):
+    """
+    Drops upstream queries that went unanswered for too long.
+
+    Clients of a query that is over its latency budget, or timed out, get the
+    stale record if there is one. A timed-out query is then sent again in the
+    background, for as long as the stale record lasts.
+    """
+    now = time.monotonic()
+    for key, waiters in pending.over_budget(now):
+        serve_stale(rr_table, metrics, key, waiters, send)
+    for (hostname, record_type), waiters in pending.expire(now):
+        metrics.count("timeouts")
+        if serve_stale(rr_table, metrics, (hostname, record_type), waiters, send):
+            ask_upstream(pending, PREFETCH, (hostname, record_type), send, rfc1035)
+            continue
+        # Clients are not left waiting forever: an unanswered name is answered as not found
+        for waiter in waiters:
+            answer_waiter(waiter, send, hostname, record_type)
+
+
+def answer_waiter(waiter, send, name, record_type=None, result=None, ttl=None, rfc1035_rcode=None):
+    """
+    Delivers an answer to a waiter: (client address, query) for a single query, or
+    (BatchQuery, index) for one question of a batch. No result means not found;
+    rfc1035_rcode is passed on to RFC 1035 clients (see build_response()).
+    """
+    if waiter is PREFETCH:
+        return
+    target, request = waiter
+    if isinstance(target, BatchQuery):
+        target.answer(request, send, name, record_type, result, ttl)
+    else:
+        send(build_response(request, name, record_type, result, ttl, rfc1035_rcode), target)
+
+
+def listen(rr_table, connection, rfc1035=False, dump_interval=None, dump_file=None, stats_interval=None,
+           stale_budget=None, snapshot_file=None, snapshot_interval=None):
+    """
+    Serves `connection` (non-blocking) from a ReadinessLoop.
+
+    Upstream queries use their own socket, watched by the same loop, and a timer
+    fires when the oldest pending query is due to expire or go over stale_budget.
+    The RR table is only dumped as set up by schedule_table_dumps().
+    """
+    pending = PendingQueries(budget=stale_budget)
+    metrics = Metrics(rr_table)
+    upstream = UDPConnection(timeout=0)
+    loop = ReadinessLoop()
+    next_expiry = None
+
+    def send_all(replies):
+        started = time.perf_counter()
+        # Queries for the authoritative server leave through the upstream socket
+        connection.send_many([reply for reply in replies if reply[1] != AMAZONE_DNS_ADDRESS])
+        upstream.send_many([reply for reply in replies if reply[1] == AMAZONE_DNS_ADDRESS])
+        metrics.observe("send", time.perf_counter() - started)
+
+    def schedule_expiry():
+        nonlocal next_expiry
+        deadline = pending.next_deadline()
+        if deadline is not None and (next_expiry is None or deadline < next_expiry):
+            next_expiry = deadline
+            loop.call_at(next_expiry, on_timer)
+
+    def on_timer():
+        nonlocal next_expiry
+        next_expiry = None
+        replies = []
+        expire_pending(rr_table, pending, metrics, lambda message, address: replies.append((message, address)), rfc1035)
+        send_all(replies)
+        schedule_expiry()
+
+    def on_readable(source):
+        # Take every datagram that is ready, then send all the replies together
+        replies = []
+        queue_reply = lambda message, address: replies.append((message, address))
+        for data, connection_addr in source.receive_ready():
+            handle_message(rr_table, pending, metrics, data, connection_addr, queue_reply, rfc1035)
+        send_all(replies)
+        schedule_expiry()
+
+    loop.add_reader(connection.socket, lambda: on_readable(connection))
+    loop.add_reader(upstream.socket, lambda: on_readable(upstream))
+    schedule_table_dumps(loop, rr_table, dump_interval, dump_file)
+    if stats_interval:
+        schedule_stats_dumps(loop, metrics, stats_interval)
+    if snapshot_file and snapshot_interval:
+        schedule_snapshots(loop, rr_table, snapshot_file, snapshot_interval)
+    try:
+        loop.run()
     except KeyboardInterrupt:
         print("Keyboard interrupt received, exiting...")
     finally:
-        # Close UDP socket
+        # Close UDP sockets
+        loop.close()
+        upstream.close()
         connection.close()
-        pass
+
+
+class LocalDNSProtocol(asyncio.DatagramProtocol):
+    """asyncio counterpart of listen(): handles each datagram as it arrives, without polling."""
+
+    def __init__(self, rr_table, metrics, rfc1035=False, stale_budget=None):
+        self.rr_table = rr_table
+        self.metrics = metrics
+        self.rfc1035 = rfc1035
+        # Upstream lookups stay in flight here while other datagrams are served
+        self.pending = PendingQueries(budget=stale_budget)
+        self.transport = None
+        # Timer for the earliest pending deadline, and that deadline
+        self.expiry = None
+        self.next_expiry = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        if self.expiry is not None:
+            self.expiry.cancel()
+
+    def datagram_received(self, data, addr):
+        handle_message(self.rr_table, self.pending, self.metrics, data, addr, self.send_message, self.rfc1035)
+        self.schedule_expiry()
+
+    def schedule_expiry(self):
+        """Sets a timer for when the oldest pending query is due to expire or go over its budget."""
+        deadline = self.pending.next_deadline()
+        if deadline is not None and (self.next_expiry is None or deadline < self.next_expiry):
+            if self.expiry is not None:
+                self.expiry.cancel()
+            self.next_expiry = deadline
+            self.expiry = asyncio.get_running_loop().call_later(max(deadline - time.monotonic(), 0), self.on_timer)
+
+    def on_timer(self):
+        self.expiry = self.next_expiry = None
+        expire_pending(self.rr_table, self.pending, self.metrics, self.send_message, self.rfc1035)
+        self.schedule_expiry()
+
+    def error_received(self, exc):
+        # e.g. ECONNREFUSED when the authoritative server is down; its queries time out
+        print(f"Socket error: {exc}")
+
+    def send_message(self, message: bytes, address: tuple[str, int]):
+        started = time.perf_counter()
+        self.transport.sendto(message, address)
+        self.metrics.observe("send", time.perf_counter() - started)
+
+
+async def listen_async(rr_table, address, rfc1035=False, dump_interval=None, dump_file=None, stats_interval=None,
+                       stale_budget=None, snapshot_file=None, snapshot_interval=None):
+    """
+    Serves queries on `address` with LocalDNSProtocol until cancelled.
+
+    As in listen(), a timer fires when the oldest pending query is due to expire
+    or go over stale_budget, so a quiet socket does not hold up its answer.
+    """
+    loop = asyncio.get_running_loop()
+    metrics = Metrics(rr_table)
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: LocalDNSProtocol(rr_table, metrics, rfc1035, stale_budget), local_addr=address
+    )
+    schedule_table_dumps(loop, rr_table, dump_interval, dump_file)
+    if stats_interval:
+        schedule_stats_dumps(loop, metrics, stats_interval)
+    if snapshot_file and snapshot_interval:
+        schedule_snapshots(loop, rr_table, snapshot_file, snapshot_interval)
+    try:
+        await loop.create_future()
+    finally:
+        transport.close()
+
+
+def write_atomically(path, write, mode="w"):
+    """
+    Calls write(file) on a new temporary file next to `path`, then renames it over `path`.
+
+    Readers see the old file or the new one, never a partial one. Each call gets its
+    own temporary file, so writes that overlap cannot corrupt each other.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                     prefix=f"{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode) as temp_file:
+            write(temp_file)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def dump_table(rr_table, dump_file=None):
+    """Prints the RR table, or writes it to dump_file, replacing the previous snapshot atomically."""
+    if dump_file is None:
+        rr_table.display_table()
+        return
+    write_atomically(dump_file, rr_table.display_table)
+
+
+def schedule_table_dumps(loop, rr_table, dump_interval=None, dump_file=None):
+    """
+    Dumps the RR table on SIGUSR1 (where there is one) and, with dump_interval, every dump_interval seconds.
+
+    `loop` is a ReadinessLoop or an asyncio loop. The dump runs on a background
+    thread, so queries are not held up by the table size or terminal speed.
+    """
+    def dump():
+        threading.Thread(target=dump_table, args=(rr_table, dump_file), daemon=True).start()
+
+    def dump_periodically():
+        dump()
+        loop.call_later(dump_interval, dump_periodically)
+
+    # Windows has no SIGUSR1
+    if hasattr(signal, "SIGUSR1"):
+        loop.add_signal_handler(signal.SIGUSR1, dump)
+    if dump_interval:
+        loop.call_later(dump_interval, dump_periodically)
+
+
+def schedule_stats_dumps(loop, metrics, stats_interval):
+    """Prints a one-line JSON metrics snapshot every stats_interval seconds."""
+    def dump_stats():
+        print(json.dumps(metrics.snapshot()), flush=True)
+        loop.call_later(stats_interval, dump_stats)
+
+    loop.call_later(stats_interval, dump_stats)
+
+
+def schedule_snapshots(loop, rr_table, snapshot_file, snapshot_interval):
+    """
+    Saves a cache snapshot to snapshot_file every snapshot_interval seconds, on a background thread.
+
+    A save is skipped while the previous one is still writing, so a slow disk cannot pile them up.
+    """
+    def save():
+        if not rr_table.snapshot_lock.locked():
+            threading.Thread(target=rr_table.save_snapshot, args=(snapshot_file,), daemon=True).start()
+        loop.call_later(snapshot_interval, save)
+
+    loop.call_later(snapshot_interval, save)
 
 
 def main():
-    rr_table = RRTable()
-    connection = UDPConnection()
+    parser = argparse.ArgumentParser(description="Local DNS server")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="serve with asyncio instead of the blocking receive loop")
+    parser.add_argument("--rfc1035", action="store_true",
+                        help="speak standard RFC 1035 DNS packets to clients and upstream")
+    parser.add_argument("--dump-interval", type=float,
+                        help="dump the RR table every this many seconds (it is always dumped on SIGUSR1)")
+    parser.add_argument("--dump-file",
+                        help="write RR table dumps to this file instead of stdout")
+    parser.add_argument("--stale-window", type=float, default=0,
+                        help="keep expired records this many seconds to answer with while upstream fails (default 0, off)")
+    parser.add_argument("--stale-budget", type=float, default=1,
+                        help="with --stale-window, seconds to wait for upstream before answering stale (default 1)")
+    parser.add_argument("--max-entries", type=int,
+                        help="most records (and, separately, negative entries) to cache; the least used are evicted")
+    parser.add_argument("--max-bytes", type=int,
+                        help="evict the least used records to keep the cache's estimated memory under this many bytes")
+    parser.add_argument("--snapshot",
+                        help="load the cache from this file on startup and save it there on shutdown")
+    parser.add_argument("--snapshot-interval", type=float, default=60,
+                        help="with --snapshot, also save the cache every this many seconds (default 60, 0 for never)")
+    parser.add_argument("--stats-interval", type=float,
+                        help=f"print metrics every this many seconds (they can always be queried as {STATS_NAME})")
+    args = parser.parse_args()
+    stale_budget = args.stale_budget if args.stale_window else None
+
+    rr_table = RRTable(args.stale_window, args.max_entries, args.max_bytes)
     # Add initial records
     # These can be found in the test cases diagram
     rr_table.add_record("www.csusm.edu", "A", "144.37.5.45", "None", 1)
     rr_table.add_record("my.csusm.edu", "A", "144.37.5.150", "None", 1)
     rr_table.add_record("amazone.com", "NS", "dns.amazone.com", "None", 1)
     rr_table.add_record("dns.amazone.com", "A", "127.0.0.1", "None", 1)
+    if args.snapshot and os.path.exists(args.snapshot):
+        loaded, dropped = rr_table.load_snapshot(args.snapshot)
+        print(f"Loaded {loaded} records from {args.snapshot} ({dropped} expired)")
+    # Stop on SIGTERM as on Ctrl+C, so the shutdown snapshot is still saved
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
 
     local_dns_address = ("127.0.0.1", 21000)
-    # Bind address to UDP socket
-    connection.bind(local_dns_address)
-    #print("local server ready to recieve")
-    listen(rr_table, connection)
+    try:
+        if args.use_async:
+            try:
+                asyncio.run(listen_async(rr_table, local_dns_address, args.rfc1035, args.dump_interval, args.dump_file,
+                                         args.stats_interval, stale_budget, args.snapshot, args.snapshot_interval))
+            except KeyboardInterrupt:
+                print("Keyboard interrupt received, exiting...")
+            return
 
+        connection = UDPConnection(timeout=0)
+        # Bind address to UDP socket
+        connection.bind(local_dns_address)
+        #print("local server ready to recieve")
+        listen(rr_table, connection, args.rfc1035, args.dump_interval, args.dump_file, args.stats_interval,
+               stale_budget, args.snapshot, args.snapshot_interval)
+    finally:
+        if args.snapshot:
+            print(f"Saved {rr_table.save_snapshot(args.snapshot)} records to {args.snapshot}")
 
-def serialize():
-    # Consider creating a serialize function
-    # This can help prepare data to send through the socket
-    pass
 
+class RRTable:
+    """
+    The local server's cache.
 
-def deserialize():
-    # Consider creating a deserialize function
-    # This can help prepare data that is received from the socket
-    pass
+    Records are stored column-wise rather than as one dict each: a record is a
+    slot number into compact arrays, IPv4 and IPv6 results are packed into 4 and
+    16 bytes, and the name and type are kept once, as the "type name" key of the index.
+    Freed slots are reused. This keeps millions of cached records affordable.
 
+    The table can be bounded by entry count and by an estimate of its memory.
+    When full, records are evicted with CLOCK over their hit counts, halving a
+    record's count each time the hand passes it: names read once or never are
+    evicted before ones in steady use, so a scan of unique names cannot flush
+    the cache. Static records are never evicted.
+    """
 
-class RRTable:
-    def __init__(self):
-        self.records = {}
-        self.record_number = 0
+    # Estimated bytes per record (columns, index entry, key object) besides the key text,
+    # and per result that is not a packed address, besides its text
+    RECORD_BYTES = 136
+    STRING_BYTES = 50
+
+    def __init__(self, stale_window=0, max_entries=None, max_bytes=None):
+        """
+        Expired records are kept for `stale_window` seconds, for get_stale_record().
+        `max_entries` bounds both the records and, separately, the negative cache;
+        `max_bytes` bounds the estimated memory of the records.
+        """
+        self.stale_window = stale_window
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bytes_used = 0
+        self.evictions = 0
+        self.negative_evictions = 0
+        self.clock_hand = 0
+        # "type name" -> slot
+        self.index = {}
+        # Columns, indexed by slot. A freed slot has key None
+        self.keys = []
+        self.types = bytearray()
+        # IPv4 results as 32-bit integers and IPv6 ones as 16 bytes per slot; any other result lives in `results`
+        self.addresses = array.array("I")
+        self.addresses6 = bytearray()
+        self.results = {}
+        # Absolute monotonic deadline and full ttl; both are inf for static records
+        self.expires = array.array("d")
+        self.lifetimes = array.array("d")
+        # How often each record was read, for refresh-ahead
+        self.hits = array.array("I")
+        self.statics = bytearray()
+        self.free_slots = array.array("I")
+        # Records are swept a second at a time: whole second -> slots whose deadline falls in it
+        self.expiry_buckets = {}
+        # Min-heap of the seconds in expiry_buckets
+        self.bucket_heap = []
+        # Negative cache, kept apart from the records: (hostname, type) -> expiry deadline
+        self.negative = {}
+        self.negative_heap = []
 
         # Start the background thread
         self.lock = threading.Lock()
-        self.thread = threading.Thread(target=self.__decrement_ttl, daemon=True)
+        # Held while a snapshot is written, so saves run one at a time and in order
+        self.snapshot_lock = threading.Lock()
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self.__expire_records, daemon=True)
         self.thread.start()
 
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        """
+        Stops the background expiry thread, which otherwise keeps the table alive.
+
+        The table can still be used, but expired records are then only dropped as they are read.
+        """
+        self.closed.set()
+        self.thread.join()
+
     def add_record(self, hostname, record_type, result, ttl, static):
+        # Static records never expire
+        lifetime = math.inf if ttl in (None, "None") else ttl
+        address = self.__pack_address(record_type, result)
+        with self.lock:
+            now = time.monotonic()
+            self.__store(hostname, record_type, result, address, now + lifetime, lifetime, 0, static, now)
+
+    def __store(self, hostname, record_type, result, address, expires, lifetime, hits, static, now):
+        # This method is only called within a locked context
+        key = f"{record_type} {hostname}"
+        # A fresh answer replaces the old entry for the same name and type, in its slot
+        slot = self.index.get(key)
+        if slot is None:
+            record_bytes = self.__record_bytes(key, result if address is None else None)
+            while self.__over_budget(record_bytes) and self.__evict(now):
+                pass
+            slot = self.__allocate_slot()
+            self.index[key] = slot
+            self.keys[slot] = key
+        else:
+            self.bytes_used -= self.__slot_bytes(slot)
+            # A refreshed record keeps its hit count, or refresh-ahead would make the hottest names the first evicted
+            hits = max(hits, self.hits[slot])
+        self.types[slot] = DNSTypes.get_type_code(record_type) or 0
+        if address is None:
+            self.results[slot] = result
+        else:
+            self.results.pop(slot, None)
+            if record_type == "AAAA":
+                self.addresses6[16 * slot:16 * slot + 16] = address
+            else:
+                self.addresses[slot] = address
+        self.expires[slot] = expires
+        self.lifetimes[slot] = lifetime
+        self.hits[slot] = hits
+        self.statics[slot] = static
+        self.bytes_used += self.__slot_bytes(slot)
+        if expires != math.inf:
+            second = math.ceil(expires)
+            bucket = self.expiry_buckets.get(second)
+            if bucket is None:
+                bucket = self.expiry_buckets[second] = array.array("I")
+                heapq.heappush(self.bucket_heap, second)
+            bucket.append(slot)
+        # The name exists now, so forget any earlier "Record Not Found"
+        self.negative.pop((hostname, record_type), None)
+        self.negative.pop((hostname, None), None)
+
+    def add_negative_record(self, hostname, ttl, record_type=None):
+        """Remembers for `ttl` seconds that `hostname` has no record of `record_type` (None: any type)."""
+        with self.lock:
+            expires = time.monotonic() + ttl
+            if self.max_entries is not None and len(self.negative) >= self.max_entries and (hostname, record_type) not in self.negative:
+                # Full: the oldest negative entry goes; its heap entry is skipped when the sweep reaches it
+                del self.negative[next(iter(self.negative))]
+                self.negative_evictions += 1
+            self.negative[(hostname, record_type)] = expires
+            heapq.heappush(self.negative_heap, (expires, hostname, record_type or ""))
+
+    def is_negative(self, hostname, record_type=None):
+        """True if the lookup is cached as not found and that answer has not expired."""
         with self.lock:
-                self.records[self.record_number] = {
-                    "name": hostname,
-                    "type": record_type,
-                    "result": result,
-                    "ttl": ttl,
-                    "static" : static
-                }
-        self.record_number += 1
-
-    def get_record(self, hostname):
+            expires = self.negative.get((hostname, record_type))
+            if expires is None:
+                return False
+            if expires <= time.monotonic():
+                del self.negative[(hostname, record_type)]
+                return False
+            return True
+
+    def get_record(self, hostname, record_type=None):
+        """
+        Looks up a record by hostname and optionally type.
+
+        Returns a copy of the record with "ttl" set to the remaining lifetime
+        in seconds, or None. Expired records are evicted on the way. Each hit
+        is counted in the record's "hits".
+        """
         with self.lock:
-            for record_id, record in self.records.items():
-                if(record["name"] == hostname):
+            now = time.monotonic()
+            if record_type is not None:
+                return self.__live_record(hostname, record_type, now)
+            # No type given: try each known type, still constant-time
+            for type_name in DNSTypes.name_to_code:
+                record = self.__live_record(hostname, type_name, now)
+                if record:
                     return record
         return None
 
-    def display_table(self):
+    def get_stale_record(self, hostname, record_type=None):
+        """
+        Looks up a record that has expired but is still inside the stale window.
+
+        Returns a copy like get_record() does, with "ttl" 0, or None.
+        """
+        with self.lock:
+            now = time.monotonic()
+            for type_name in (record_type,) if record_type is not None else DNSTypes.name_to_code:
+                slot = self.index.get(f"{type_name} {hostname}")
+                if slot is not None and self.expires[slot] <= now < self.expires[slot] + self.stale_window:
+                    return dict(self.__record(slot, hostname, type_name), ttl=0)
+        return None
+
+    def remove_record(self, hostname, record_type):
+        with self.lock:
+            slot = self.index.get(f"{record_type} {hostname}")
+            if slot is not None:
+                self.__free_slot(slot)
+
+    def save_snapshot(self, path):
+        """
+        Writes the records that have a ttl to `path` for load_snapshot(), replacing it atomically.
+
+        Static records are left out, since they are added at startup anyway. The lock
+        is only held while the columns are copied. A save waits for one already being
+        written, so the last one started is the one left in `path`.
+        Returns the number of records written.
+        """
+        with self.snapshot_lock:
+            with self.lock:
+                keys = list(self.keys)
+                addresses = self.addresses[:]
+                addresses6 = bytes(self.addresses6)
+                results = dict(self.results)
+                expires = self.expires[:]
+                lifetimes = self.lifetimes[:]
+                hits = self.hits[:]
+                clock_offset = time.time() - time.monotonic()
+            count = 0
+
+            def write(snapshot):
+                nonlocal count
+                # The count is filled in once the records are written
+                snapshot.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0))
+                chunk = []
+                for slot, key in enumerate(keys):
+                    if key is None or expires[slot] == math.inf:
+                        continue
+                    key = key.encode()
+                    if slot in results:
+                        flags = 0
+                        result = results[slot].encode()
+                        result = WIRE_LENGTH.pack(len(result)) + result
+                    elif key.startswith(b"AAAA "):
+                        flags = SNAPSHOT_IPV6
+                        result = addresses6[16 * slot:16 * slot + 16]
+                    else:
+                        flags = SNAPSHOT_IPV4
+                        result = addresses[slot].to_bytes(4, "big")
+                    chunk += (SNAPSHOT_RECORD.pack(flags, expires[slot] + clock_offset, lifetimes[slot], hits[slot], len(key)),
+                              key, result)
+                    count += 1
+                    if len(chunk) >= 30000:
+                        snapshot.write(b"".join(chunk))
+                        chunk = []
+                snapshot.write(b"".join(chunk))
+                snapshot.seek(0)
+                snapshot.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, count))
+
+            write_atomically(path, write, "wb")
+            return count
+
+    def load_snapshot(self, path):
+        """
+        Adds the records saved by save_snapshot(), with their remaining ttl and hit counts.
+
+        Records that expired since (beyond the stale window) are dropped.
+        Returns:
+            tuple (loaded, dropped): how many records were added and how many had expired.
+        """
+        with open(path, "rb") as snapshot:
+            data = snapshot.read()
+        magic, version, count = SNAPSHOT_HEADER.unpack_from(data)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError(f"{path} is not a version {SNAPSHOT_VERSION} cache snapshot")
+        offset = SNAPSHOT_HEADER.size
+        loaded = 0
+        with self.lock:
+            now = time.monotonic()
+            clock_offset = time.time() - now
+            for _ in range(count):
+                flags, expires, lifetime, hits, key_length = SNAPSHOT_RECORD.unpack_from(data, offset)
+                offset += SNAPSHOT_RECORD.size
+                record_type, _, hostname = data[offset:offset + key_length].decode().partition(" ")
+                offset += key_length
+                if flags & SNAPSHOT_IPV4:
+                    result = None
+                    address = int.from_bytes(data[offset:offset + 4], "big")
+                    offset += 4
+                elif flags & SNAPSHOT_IPV6:
+                    result = None
+                    address = data[offset:offset + 16]
+                    offset += 16
+                else:
+                    (result_length,) = WIRE_LENGTH.unpack_from(data, offset)
+                    offset += WIRE_LENGTH.size
+                    result = data[offset:offset + result_length].decode()
+                    # Snapshots from before SNAPSHOT_IPV6 have AAAA results as text
+                    address = self.__pack_address(record_type, result)
+                    offset += result_length
+                expires -= clock_offset
+                if expires + self.stale_window <= now:
+                    continue
+                self.__store(hostname, record_type, result, address, expires, lifetime, hits, 0, now)
+                loaded += 1
+        return loaded, count - loaded
+
+    def stats(self):
+        """Returns the cache size and eviction counters, for sizing the cache."""
         with self.lock:
-            # Display the table in the following format (include the column names):
-            # record_number,name,type,result,ttl,static
-            #print(f"{'record_number':<15}{'name':<20}{'type':<10}{'result':<30}{'ttl':<6}{'static':<6}")
-            #print('-' * 90)
-            print("record_no,name,type,result,ttl,static")
-            for record_id, record in self.records.items():
-                 #print(f"{record_id:<15}{record['name']:<20}{record['type']:<10}{record['result']:<30}{record['ttl']:<6}{record['static']:<6}")
-                 thing = str(record_id) + "," + str(record['name']) + "," + str(record['type']) + "," + str(record['result']) + "," + str(record['ttl']) + "," + str(record['static'])
-                 print(thing)
-
-    def __decrement_ttl(self):
+            return {
+                "entries": len(self.index),
+                "negative_entries": len(self.negative),
+                "bytes": self.bytes_used,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+                "negative_evictions": self.negative_evictions
+            }
+
+    def display_table(self, out=None):
+        """Writes the table to `out` (stdout by default). The lock is only held while the columns are copied."""
+        with self.lock:
+            keys = list(self.keys)
+            addresses = self.addresses[:]
+            addresses6 = bytes(self.addresses6)
+            results = dict(self.results)
+            expires = self.expires[:]
+            statics = self.statics[:]
+        # Display the table in the following format (include the column names):
+        # record_number,name,type,result,ttl,static
+        now = time.monotonic()
+        lines = ["record_no,name,type,result,ttl,static"]
+        record_no = 0
+        for slot, key in enumerate(keys):
+            if key is None:
+                continue
+            record_type, _, name = key.partition(" ")
+            result = self.__result(slot, record_type, results, addresses, addresses6)
+            lines.append(f"{record_no},{name},{record_type},{result},{self.__remaining_ttl(expires[slot], now)},{statics[slot]}")
+            record_no += 1
+        (out or sys.stdout).write("\n".join(lines) + "\n")
+
+    @staticmethod
+    def __pack_address(record_type, result):
+        # The packed form of an A or AAAA result, or None to keep it as text
+        try:
+            if record_type == "A":
+                return int.from_bytes(socket.inet_pton(socket.AF_INET, result), "big")
+            if record_type == "AAAA":
+                return socket.inet_pton(socket.AF_INET6, result)
+        except (OSError, TypeError):
+            pass
+        return None
+
+    @staticmethod
+    def __result(slot, record_type, results, addresses, addresses6):
+        # Takes the columns, so that copies made under the lock can be read after it is released
+        if slot in results:
+            return results[slot]
+        if record_type == "AAAA":
+            return socket.inet_ntop(socket.AF_INET6, addresses6[16 * slot:16 * slot + 16])
+        return socket.inet_ntop(socket.AF_INET, addresses[slot].to_bytes(4, "big"))
+
+    @staticmethod
+    def __remaining_ttl(expires, now):
+        # Static records have no deadline and keep their "None" ttl
+        if expires == math.inf:
+            return "None"
+        return max(0, math.ceil(expires - now))
+
+    @classmethod
+    def __record_bytes(cls, key, result=None):
+        # `result` is None for a packed IPv4 address
+        return cls.RECORD_BYTES + len(key) + (cls.STRING_BYTES + len(result) if result is not None else 0)
+
+    def __slot_bytes(self, slot):
+        # This method is only called within a locked context
+        return self.__record_bytes(self.keys[slot], self.results.get(slot))
+
+    def __over_budget(self, record_bytes):
+        # This method is only called within a locked context
+        return (
+            self.max_entries is not None and len(self.index) >= self.max_entries
+            or self.max_bytes is not None and self.bytes_used + record_bytes > self.max_bytes
+        )
+
+    def __evict(self, now):
+        # This method is only called within a locked context
+        # CLOCK: the first record with no hits left goes, ageing the others as the hand passes.
+        # After two turns without one, the record with the fewest hits seen goes instead.
+        victim = None
+        for _ in range(2 * len(self.keys)):
+            slot = self.clock_hand
+            self.clock_hand = (slot + 1) % len(self.keys)
+            expires = self.expires[slot]
+            if self.keys[slot] is None or expires == math.inf:
+                continue
+            if not self.hits[slot] or expires <= now:
+                victim = slot
+                break
+            if victim is None or self.hits[slot] < self.hits[victim]:
+                victim = slot
+            self.hits[slot] >>= 1
+        if victim is None:
+            # Nothing but static records
+            return False
+        self.__free_slot(victim)
+        self.evictions += 1
+        return True
+
+    def __allocate_slot(self):
+        # This method is only called within a locked context
+        if self.free_slots:
+            return self.free_slots.pop()
+        self.keys.append(None)
+        self.types.append(0)
+        self.addresses.append(0)
+        self.addresses6.extend(bytes(16))
+        self.expires.append(0)
+        self.lifetimes.append(0)
+        self.hits.append(0)
+        self.statics.append(0)
+        return len(self.keys) - 1
+
+    def __free_slot(self, slot):
+        # This method is only called within a locked context
+        self.bytes_used -= self.__slot_bytes(slot)
+        del self.index[self.keys[slot]]
+        self.keys[slot] = None
+        self.results.pop(slot, None)
+        self.free_slots.append(slot)
+
+    def __record(self, slot, hostname, record_type):
+        # This method is only called within a locked context
+        expires = self.expires[slot]
+        static_record = expires == math.inf
+        return {
+            "name": hostname,
+            "type": record_type,
+            "result": self.__result(slot, record_type, self.results, self.addresses, self.addresses6),
+            "ttl": self.__remaining_ttl(expires, time.monotonic()),
+            "expires": None if static_record else expires,
+            "lifetime": None if static_record else self.lifetimes[slot],
+            "hits": self.hits[slot],
+            "static": self.statics[slot]
+        }
+
+    def __live_record(self, hostname, record_type, now):
+        # This method is only called within a locked context
+        slot = self.index.get(f"{record_type} {hostname}")
+        if slot is None:
+            return None
+        expires = self.expires[slot]
+        if expires <= now:
+            # Lazily evict once past the stale window; the bucket entry is skipped when the sweep reaches it
+            if expires + self.stale_window <= now:
+                self.__free_slot(slot)
+            return None
+        if self.hits[slot] != 0xFFFFFFFF:
+            self.hits[slot] += 1
+        return self.__record(slot, hostname, record_type)
+
+    def __expire_records(self):
         while True:
             with self.lock:
-                # Decrement ttl
-                for record_id, record in self.records.items():
-                    if(record['ttl'] != "None" and record['ttl'] > 0):
-                        record['ttl'] -= 1   
-                self.__remove_expired_records()
-            time.sleep(1)
-
-    def __remove_expired_records(self):
+                self.__remove_expired_records(time.monotonic())
+            if self.closed.wait(1):
+                return
+
+    def __remove_expired_records(self, now):
         # This method is only called within a locked context
 
-        # Remove expired records
-        expired_keys = [key for key, record in self.records.items() if record['ttl'] != "None" and record['ttl'] <= 0]
-        for key in expired_keys:
-            del self.records[key]
-        # Update record numbers
-        new_record_number = 0
-        new_records = {}
-        
-        for key, record in sorted(self.records.items()):
-            record['record_number'] = new_record_number
-            new_records[new_record_number] = record
-            new_record_number += 1
-        
-        self.records = new_records
-        self.record_number = new_record_number
+        # Reclaims expired records nobody has read since they expired.
+        # Only buckets whose second (plus the stale window) has passed are visited; the rest of the table is untouched
+        while self.bucket_heap and self.bucket_heap[0] + self.stale_window <= now:
+            for slot in self.expiry_buckets.pop(heapq.heappop(self.bucket_heap)):
+                # Skip slots that were freed, or reused by a record that expires later
+                if self.keys[slot] is not None and self.expires[slot] + self.stale_window <= now:
+                    self.__free_slot(slot)
+
+        while self.negative_heap and self.negative_heap[0][0] <= now:
+            expires, hostname, record_type = heapq.heappop(self.negative_heap)
+            key = (hostname, record_type or None)
+            if self.negative.get(key) == expires:
+                del self.negative[key]
 
 
-class DNSTypes:
+class BatchQuery:
+    """Collects the answers to one batch query and sends them back in a single datagram."""
+
+    def __init__(self, request, client_address):
+        self.request = request
+        self.client_address = client_address
+        self.answers = [None] * len(request["batch"])
+        self.remaining = len(self.answers)
+
+    def answer(self, index, send, name, record_type=None, result=None, ttl=None):
+        """Fills in the answer to question `index`; the response goes out through `send` once all are in."""
+        if self.answers[index] is not None:
+            return
+        self.answers[index] = (name, record_type, result, ttl)
+        self.remaining -= 1
+        if not self.remaining:
+            send(build_batch_response(self.request, self.answers), self.client_address)
+
+
+class PendingQueries:
     """
-    A class to manage DNS query types and their corresponding codes.
+    Tracks queries forwarded to the authoritative server that are still waiting for an answer.
 
-    Examples:
-    >>> DNSTypes.get_type_code('A')
-    8
-    >>> DNSTypes.get_type_name(0b0100)
-    'AAAA'
+    Misses for a (hostname, type) that is already in flight join the existing query instead
+    of sending another one, and every waiting client gets the answer when it arrives.
     """
 
-    name_to_code = {
-        "A": 0b1000,
-        "AAAA": 0b0100,
-        "CNAME": 0b0010,
-        "NS": 0b0001,
-    }
+    def __init__(self, timeout: float = 5, budget: float | None = None):
+        """
+        Initializes the table. Queries unanswered after `timeout` seconds are dropped.
+        With a `budget`, queries unanswered after that many seconds are also reported
+        once by over_budget(), while they stay in flight.
+        """
+        self.timeout = timeout
+        self.budget = budget
+        # (budget deadline, transaction_id, deadline) in the order the queries were sent
+        self.budget_deadlines = collections.deque()
+        # transaction_id -> ((hostname, type), [waiters]); a waiter is (client address, query)
+        self.queries = {}
+        # (hostname, type) -> transaction_id of its in-flight query
+        self.by_name = {}
+        # (deadline, transaction_id) in the order the queries were sent
+        self.deadlines = collections.deque()
+        # transaction_id -> deadline, so an expired id that was reused is left alone
+        self.expires_at = {}
+        self.next_id = 0
 
-    code_to_name = {code: name for name, code in name_to_code.items()}
+    def add(self, waiter: tuple, key: tuple):
+        """
+        Registers a waiter for the (hostname, type) `key`.
 
-    @staticmethod
-    def get_type_code(type_name: str):
-        """Gets the code for the given DNS query type name, or None"""
-        return DNSTypes.name_to_code.get(type_name, None)
+        Returns:
+            tuple (transaction_id, is_new): is_new is False when the client joined a
+            query already in flight, in which case nothing needs to be sent upstream.
+            transaction_id is None when all 65536 ids are in flight; the waiter was
+            not registered and has to be answered by the caller.
+        """
+        transaction_id = self.by_name.get(key)
+        if transaction_id is not None:
+            self.queries[transaction_id][1].append(waiter)
+            return transaction_id, False
+        if len(self.queries) > 0xFFFF:
+            return None, False
+
+        # 16-bit ids like DNS, skipping any that are still in flight
+        transaction_id = self.next_id
+        while transaction_id in self.queries:
+            transaction_id = (transaction_id + 1) & 0xFFFF
+        self.next_id = (transaction_id + 1) & 0xFFFF
+        self.queries[transaction_id] = (key, [waiter])
+        self.by_name[key] = transaction_id
+        deadline = time.monotonic() + self.timeout
+        self.expires_at[transaction_id] = deadline
+        self.deadlines.append((deadline, transaction_id))
+        if self.budget is not None:
+            self.budget_deadlines.append((deadline - self.timeout + self.budget, transaction_id, deadline))
+        return transaction_id, True
+
+    def is_overdue(self, key: tuple):
+        """True if the query for the (hostname, type) `key` is in flight and over its budget."""
+        transaction_id = self.by_name.get(key)
+        if transaction_id is None or self.budget is None:
+            return False
+        return self.expires_at[transaction_id] - self.timeout + self.budget <= time.monotonic()
+
+    def over_budget(self, now: float):
+        """Returns ((hostname, type), waiters) for each query that went over its budget since the last call."""
+        overdue = []
+        while self.budget_deadlines and self.budget_deadlines[0][0] <= now:
+            _, transaction_id, deadline = self.budget_deadlines.popleft()
+            if self.expires_at.get(transaction_id) == deadline:
+                overdue.append(self.queries[transaction_id])
+        return overdue
+
+    def next_deadline(self):
+        """The earliest time expire() or over_budget() has something to return, or None"""
+        deadlines = [queue[0][0] for queue in (self.deadlines, self.budget_deadlines) if queue]
+        return min(deadlines) if deadlines else None
+
+    def in_flight(self, key: tuple):
+        """True if a query for the (hostname, type) `key` is waiting on the authoritative server."""
+        return key in self.by_name
+
+    def sent_at(self, transaction_id: int):
+        """Returns the time.monotonic() at which the query with this id went upstream, or None"""
+        deadline = self.expires_at.get(transaction_id)
+        return None if deadline is None else deadline - self.timeout
+
+    def pop(self, transaction_id: int):
+        """Removes and returns ((hostname, type), waiters) for the id, or None"""
+        query = self.queries.pop(transaction_id, None)
+        if query is not None:
+            del self.by_name[query[0]]
+            del self.expires_at[transaction_id]
+        return query
+
+    def expire(self, now: float):
+        """Drops queries whose deadline has passed and returns them as ((hostname, type), waiters)."""
+        expired = []
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, transaction_id = self.deadlines.popleft()
+            # The id may already have been answered, or answered and reused
+            if self.expires_at.get(transaction_id) == deadline:
+                expired.append(self.pop(transaction_id))
+        return expired
+
+
+class Metrics:
+    """
+    Request counters and per-stage latency histograms for the local server.
+
+    Recording a sample is one list increment, so metrics stay on all the time.
+    Latencies are kept in power-of-two microsecond buckets: bucket i counts
+    samples below 2**i microseconds, and percentiles report that upper bound.
+    """
+
+    COUNTERS = ("queries", "hits", "misses", "forwards", "negative", "timeouts", "prefetches", "stale", "malformed")
+    STAGES = ("lookup", "upstream", "send")
+    BUCKETS = 32
+
+    def __init__(self, rr_table=None):
+        """With an `rr_table`, snapshots include its size and eviction counters."""
+        self.rr_table = rr_table
+        self.started = time.monotonic()
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.histograms = {stage: [0] * self.BUCKETS for stage in self.STAGES}
+        self.drops = DropReport()
+
+    def count(self, counter: str, amount: int = 1):
+        self.counters[counter] += amount
+
+    def drop(self, address, reason):
+        """Counts a dropped datagram as "malformed" and reports it in the rate-limited log."""
+        self.counters["malformed"] += 1
+        self.drops.drop(address, reason)
+
+    def observe(self, stage: str, seconds: float):
+        """Records one latency sample for `stage`."""
+        bucket = min(int(seconds * 1_000_000).bit_length(), self.BUCKETS - 1)
+        self.histograms[stage][bucket] += 1
+
+    def snapshot(self):
+        """Returns the counters, QPS, hit ratio and latency percentiles as a JSON-ready dict."""
+        uptime = time.monotonic() - self.started
+        counters = dict(self.counters)
+        answered = counters["hits"] + counters["misses"]
+        return {
+            "uptime": round(uptime, 3),
+            "qps": round(counters["queries"] / uptime, 3),
+            "hit_ratio": round(counters["hits"] / answered, 4) if answered else None,
+            **counters,
+            "latency_us": {stage: self.__percentiles(list(histogram)) for stage, histogram in self.histograms.items()},
+            "cache": self.rr_table.stats() if self.rr_table is not None else None
+        }
 
     @staticmethod
-    def get_type_name(type_code: int):
-        """Gets the DNS query type name for the given code, or None"""
-        return DNSTypes.code_to_name.get(type_code, None)
+    def __percentiles(histogram):
+        total = sum(histogram)
+        summary = {"count": total}
+        for label, fraction in (("p50", 0.5), ("p99", 0.99), ("p999", 0.999)):
+            seen = 0
+            for bucket, samples in enumerate(histogram):
+                seen += samples
+                if total and seen >= fraction * total:
+                    summary[label] = 2 ** bucket
+                    break
+            else:
+                summary[label] = None
+        return summary
+
+
+class ReadinessLoop:
+    """
+    A single-threaded selectors (epoll/kqueue) loop.
+
+    It sleeps until a registered socket is readable or the next timer is due,
+    so an idle server does not wake up at all.
+    """
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        # Min-heap of (deadline, sequence, callback); the sequence breaks ties
+        self.timers = []
+        self.sequence = itertools.count()
+        # Signals are written to this socketpair by the interpreter, which wakes select() up
+        self.signal_handlers = {}
+        self.signal_reader = None
+        self.signal_writer = None
+
+    def add_reader(self, sock: socket.socket, callback):
+        """Calls callback() whenever `sock` has data to read."""
+        self.selector.register(sock, selectors.EVENT_READ, callback)
+
+    def call_at(self, deadline: float, callback):
+        """Calls callback() once time.monotonic() reaches `deadline`."""
+        heapq.heappush(self.timers, (deadline, next(self.sequence), callback))
+
+    def call_later(self, delay: float, callback):
+        """Calls callback() after `delay` seconds, like asyncio's loop.call_later."""
+        self.call_at(time.monotonic() + delay, callback)
+
+    def add_signal_handler(self, signum: int, callback):
+        """Calls callback() from the loop when `signum` arrives, like asyncio's loop.add_signal_handler."""
+        if self.signal_reader is None:
+            self.signal_reader, self.signal_writer = socket.socketpair()
+            self.signal_reader.setblocking(False)
+            self.signal_writer.setblocking(False)
+            signal.set_wakeup_fd(self.signal_writer.fileno())
+            self.add_reader(self.signal_reader, self.__dispatch_signals)
+        self.signal_handlers[signum] = callback
+        # The Python-level handler does nothing; the work happens in the loop, outside the handler
+        signal.signal(signum, lambda *_: None)
+
+    def __dispatch_signals(self):
+        try:
+            signums = self.signal_reader.recv(64)
+        except BlockingIOError:
+            return
+        for signum in signums:
+            if signum in self.signal_handlers:
+                self.signal_handlers[signum]()
+
+    def run(self):
+        """Dispatches readiness events and timers until interrupted."""
+        while True:
+            timeout = max(0, self.timers[0][0] - time.monotonic()) if self.timers else None
+            for key, _ in self.selector.select(timeout):
+                key.data()
+            now = time.monotonic()
+            while self.timers and self.timers[0][0] <= now:
+                _, _, callback = heapq.heappop(self.timers)
+                callback()
+
+    def close(self):
+        if self.signal_reader is not None:
+            signal.set_wakeup_fd(-1)
+            for signum in self.signal_handlers:
+                signal.signal(signum, signal.SIG_DFL)
+            self.signal_reader.close()
+            self.signal_writer.close()
+        self.selector.close()
 
 
 class UDPConnection:
     """A class to handle UDP socket communication, capable of acting as both a client and a server."""
 
-    def __init__(self, timeout: int = 1):
-        """Initializes the UDPConnection instance with a timeout. Defaults to 1."""
+    def __init__(self, timeout: int = 1, batch_size: int = 64):
+        """
+        Initializes the UDPConnection instance with a timeout. Defaults to 1; 0 makes it non-blocking.
+
+        batch_size receive buffers are allocated once and reused for every datagram.
+        """
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.settimeout(timeout)
         self.is_bound = False
+        self.buffers = [memoryview(bytearray(MAX_DATAGRAM)) for _ in range(batch_size)]
 
-    def send_message(self, message: str, address: tuple[str, int]):
-        """Sends a message to the specified address."""
-        self.socket.sendto(message.encode(), address)
+    def send_message(self, message: str | bytes, address: tuple[str, int]):
+        """Sends a message to the specified address. Strings are UTF-8 encoded first."""
+        if isinstance(message, str):
+            message = message.encode()
+        self.socket.sendto(message, address)
 
-    def receive_message(self):
+    def send_many(self, messages: list):
+        """Sends a list of (message, address) pairs, e.g. all replies from one receive_ready() call."""
+        sendto = self.socket.sendto
+        for message, address in messages:
+            if isinstance(message, str):
+                message = message.encode()
+            sendto(message, address)
+
+    def receive_ready(self):
         """
-        Receives a message from the socket.
+        Receives every datagram that is ready, without blocking.
 
-        Returns:
-            tuple (data, address): The received message and the address it came from.
+        Meant for a non-blocking connection (timeout=0) driven by a ReadinessLoop.
+        The returned memoryviews point into the reused buffers, so they are only
+        valid until the next call.
 
-        Raises:
-            KeyboardInterrupt: If the program is interrupted manually.
+        Returns:
+            list of (data, address) tuples, empty if nothing was ready.
         """
-        while True:
+        messages = []
+        for buffer in self.buffers:
             try:
-                data, address = self.socket.recvfrom(4096)
-                return data.decode(), address
-            except socket.timeout:
-                continue
-            except OSError as e:
-                if e.errno == errno.ECONNRESET:
-                    print("Error: Unable to reach the other socket. It might not be up and running.")
-                else:
-                    print(f"Socket error: {e}")
-                self.close()
-                sys.exit(1)
-            except KeyboardInterrupt:
-                raise
+                nbytes, address = self.socket.recvfrom_into(buffer)
+            except OSError:
+                # Nothing more ready, or e.g. ECONNREFUSED left by an earlier send; either way stop here
+                break
+            messages.append((buffer[:nbytes], address))
+        return messages
 
     def bind(self, address: tuple[str, int]):
         """Binds the socket to the given address. This means it will be a server."""